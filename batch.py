@@ -0,0 +1,210 @@
+"""Batch pipeline for comparisons that are all known upfront, e.g. the AB and BA orders of position_pairs.
+
+All requests are written to a JSONL file in the OpenAI/Azure batch format, one line per comparison and vote:
+
+    {"custom_id": "<d1>:<d2>:<vote>", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+The file is either submitted to the batch API of the provider or run through a local worker pool. The results
+are written in the batch output format and joined back to the comparisons by their custom_id.
+"""
+import contextvars
+import json
+import os
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from llm import PRPmodel
+from logs import global_logger as logging
+
+BATCH_MODES = ["local", "submit"]
+# states of a batch job in which it will not change anymore
+FINAL_STATES = ["completed", "failed", "expired", "cancelled"]
+
+
+def pair_id(d1, d2, vote: int = 0) -> str:
+    return f"{d1}:{d2}:{vote}"
+
+
+def parse_pair_id(custom_id: str) -> tuple[str, str, int]:
+    d1, d2, vote = custom_id.rsplit(":", 2)
+    return d1, d2, int(vote)
+
+
+def position_pair_comparisons(pairs: list[tuple]) -> list[tuple]:
+    """Both orders AB and BA of every pair, as compared by position_pairs."""
+    return [order for a, b in pairs for order in ((a, b), (b, a))]
+
+
+def build_requests(prp: PRPmodel, comparisons: list[tuple]) -> list[dict]:
+    """One batch request per comparison and vote, with the same request body as a single comparison.
+    Requests with the same notebook at the beginning of the prompt are kept together for prefix caching."""
+    url = urllib.parse.urlparse(prp.API_ENDPOINT or "/v1/chat/completions").path or "/v1/chat/completions"
+    comparisons = sorted(comparisons, key=lambda pair: prp.prefix_notebook(*pair))
+    return [
+        {
+            "custom_id": pair_id(d1, d2, vote),
+            "method": "POST",
+            "url": url,
+            "body": prp.request_data(*prp.build_pair(d1, d2)),
+        }
+        for d1, d2 in comparisons for vote in prp.vote_indices()
+    ]
+
+
+def write_jsonl(path: str, lines: list[dict]):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def read_jsonl(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_local(prp: PRPmodel, requests: list[dict], max_concurrency: int = 8) -> list[dict]:
+    """Runs the batch requests through a local worker pool and returns them in the batch output format.
+    The requests go through send_prompt, so they share the comparison cache and the rate limits."""
+    def run(request: dict) -> dict:
+        d1, d2, vote = parse_pair_id(request["custom_id"])
+        response = prp.send_prompt(*prp.build_pair(d1, d2), 0, vote)
+        return {
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200 if response else 500, "body": response},
+            "error": None if response else {"message": "No valid response after max retries."},
+        }
+
+    logging.info(f"Running batch of {len(requests)} requests locally with up to {max_concurrency} workers.")
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, request) for request in requests]
+        return [future.result() for future in futures]
+
+
+class BatchAPI:
+    """Client for the files and batches endpoints of OpenAI-compatible providers."""
+    def __init__(self, base_url: str, api_key: str, poll_interval: float = 60, timeout: float = 120):
+        self.base_url = base_url.rstrip("/")
+        # Azure OpenAI expects the key in the api-key header, the others as bearer token
+        self.headers = {"Authorization": f"Bearer {api_key}", "api-key": api_key}
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    @classmethod
+    def for_model(cls, prp: PRPmodel, base_url: str | None = None, poll_interval: float = 60) -> "BatchAPI":
+        """Uses the endpoint of the model without the chat completions path, unless base_url is given."""
+        if base_url is None:
+            base_url = prp.API_ENDPOINT.split("?")[0].removesuffix("/").removesuffix("/chat/completions")
+        return cls(base_url, prp.API_KEY, poll_interval, prp.clients.http.timeout)
+
+    def submit(self, path: str, endpoint: str) -> str:
+        """Uploads the request file and creates the batch job. Returns the batch id."""
+        with open(path, "rb") as f:
+            response = httpx.post(f"{self.base_url}/files", headers=self.headers, timeout=self.timeout,
+                                  files={"file": (os.path.basename(path), f, "application/jsonl")},
+                                  data={"purpose": "batch"})
+        response.raise_for_status()
+        file_id = response.json()["id"]
+        response = httpx.post(f"{self.base_url}/batches", headers=self.headers, timeout=self.timeout,
+                              json={"input_file_id": file_id, "endpoint": endpoint, "completion_window": "24h"})
+        response.raise_for_status()
+        batch_id = response.json()["id"]
+        logging.info(f"Submitted batch {batch_id} with input file {file_id}.")
+        return batch_id
+
+    def wait(self, batch_id: str) -> dict:
+        """Polls the batch job until it reached a final state and returns it."""
+        while True:
+            response = httpx.get(f"{self.base_url}/batches/{batch_id}", headers=self.headers, timeout=self.timeout)
+            response.raise_for_status()
+            batch = response.json()
+            logging.info(f"Batch {batch_id} is {batch['status']}: {batch.get('request_counts')}")
+            if batch["status"] in FINAL_STATES:
+                return batch
+            time.sleep(self.poll_interval)
+
+    def download(self, file_id: str) -> list[dict]:
+        response = httpx.get(f"{self.base_url}/files/{file_id}/content", headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+    def run(self, path: str, endpoint: str) -> list[dict]:
+        """Submits the request file, waits for the batch and returns the results of all requests."""
+        batch = self.wait(self.submit(path, endpoint))
+        results = []
+        for file_key in ("output_file_id", "error_file_id"):
+            if batch.get(file_key):
+                results += self.download(batch[file_key])
+        if batch["status"] != "completed":
+            logging.error(f"Batch {batch['id']} ended as {batch['status']}: {batch.get('errors')}")
+        return results
+
+
+def cache_results(prp: PRPmodel, results: list[dict]):
+    """Stores successful responses of a submitted batch in the comparison cache, under the same keys as
+    single comparisons, so that later experiments reuse them."""
+    if prp.cache is None:
+        return
+    for result in results:
+        body = (result.get("response") or {}).get("body")
+        if body and body.get("choices"):
+            d1, d2, vote = parse_pair_id(result["custom_id"])
+            prp.cache.put(prp.cache_key(*prp.build_pair(d1, d2), 0, vote), body)
+
+
+def join_results(prp: PRPmodel, comparisons: list[tuple], results: list[dict]) -> dict[tuple, bool]:
+    """Joins the batch results to the comparisons by custom_id and returns cmp(d1, d2) for each comparison.
+    Missing or unparsable answers are compared again one by one, like a retry of llm_compare. With majority
+    voting, the majority of the votes decides."""
+    by_id = {result["custom_id"]: result for result in results}
+    votes: dict[tuple, list[bool]] = defaultdict(list)
+    retried = 0
+    for d1, d2 in comparisons:
+        for vote in prp.vote_indices():
+            result = by_id.get(pair_id(d1, d2, vote)) or {}
+            body = (result.get("response") or {}).get("body") or {}
+            try:
+                msg = body["choices"][0]["message"]["content"].strip()
+                comparison = prp.parse_response(msg)
+            except (KeyError, IndexError, TypeError, ValueError):
+                logging.warning(f"No decisive batch result for {pair_id(d1, d2, vote)}: {result}. Comparing again.")
+                retried += 1
+                comparison = prp.llm_compare(d1, d2, err_count=1, vote=vote)
+            votes[(d1, d2)].append(comparison)
+
+    if retried:
+        logging.info(f"Compared {retried} of {len(comparisons) * len(prp.vote_indices())} batch requests again.")
+    return {comparison: sum(v) > len(v) / 2 for comparison, v in votes.items()}
+
+
+def compare_batch(prp: PRPmodel, comparisons: list[tuple], path: str, mode: str = "local",
+                  max_concurrency: int = 8, base_url: str | None = None, poll_interval: float = 60) -> dict[tuple, bool]:
+    """Writes all comparisons to <path>.requests.jsonl, runs them in the given mode, writes the results to
+    <path>.results.jsonl and returns cmp(d1, d2) for each comparison."""
+    assert mode in BATCH_MODES, f"Unknown batch mode '{mode}'."
+    if prp.local is not None:
+        # no requests to write, the local model scores all comparisons in batched forward passes
+        logging.info(f"Scoring {len(comparisons)} comparisons with the local model.")
+        return dict(zip(comparisons, prp.local_compare_batch(comparisons, both_orientations=False)))
+    requests = build_requests(prp, comparisons)
+    requests_path, results_path = f"{path}.requests.jsonl", f"{path}.results.jsonl"
+    write_jsonl(requests_path, requests)
+    logging.info(f"Wrote {len(requests)} batch requests to {requests_path}.")
+
+    if mode == "submit" and prp.provider == "Azure" and prp.model != "Llama-3.3-70B-Instruct":
+        logging.warning(f"The Azure AI inference endpoint of {prp.model} has no batch API, running the batch locally.")
+        mode = "local"
+    if mode == "submit":
+        results = BatchAPI.for_model(prp, base_url, poll_interval).run(requests_path, requests[0]["url"] if requests else "")
+        cache_results(prp, results)
+    else:
+        results = run_local(prp, requests, max_concurrency)
+    write_jsonl(results_path, results)
+    logging.info(f"Wrote {len(results)} batch results to {results_path}.")
+
+    return join_results(prp, comparisons, results)
+
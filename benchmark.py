@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the sorting algorithms with a simulated, noisy LLM comparator.
+
+Runs every algorithm on rankings seeded from expert points and reports the number of comparisons, the number of
+rounds of parallel comparisons, wall time, Kendall tau, nDCG and top-k precision. No API is called, so the
+cheapest algorithm for a given noise level can be chosen before spending money on an experiment.
+
+    python benchmark.py --csv data/test-data/photosynthese.csv --n 10 35 --noise 0 2 --repetitions 20
+"""
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from evaluation import kendall_tau, ndcg, rank_matrix
+from sort import heapsort, quicksort, bubble_sort, merge_insertion_sort, binary_insertion_sort, active_ranking, \
+    parallel_heapsort, parallel_quicksort, odd_even_sort, heap_top_k, quickselect_top_k, tournament_top_k, \
+    BatchComparator, CountingComparator
+
+SEQUENTIAL_ALGORITHMS = {
+    'heapsort': heapsort,
+    'quicksort': quicksort,
+    'bubble_sort': bubble_sort,
+    'merge_insertion_sort': merge_insertion_sort,
+    'binary_insertion_sort': binary_insertion_sort,
+    'active_ranking': active_ranking,
+}
+PARALLEL_ALGORITHMS = {
+    'parallel_heapsort': parallel_heapsort,
+    'parallel_quicksort': parallel_quicksort,
+    'odd_even_sort': odd_even_sort,
+}
+TOP_K_ALGORITHMS = {
+    'heap_top_k': heap_top_k,
+    'quickselect_top_k': quickselect_top_k,
+    'tournament_top_k': tournament_top_k,
+}
+
+
+class SimulatedComparator:
+    """
+    Simulates the answers of an LLM for cmp(x, y), i.e. "is x worse than y", based on the expert points.
+
+    - noise: scale of the logistic noise on the point difference (Bradley-Terry), 0 answers always correctly.
+      The probability of a correct answer is 1 / (1 + exp(-|points difference| / noise)).
+    - position_bias: probability of ignoring the notebooks and answering by position; positive values prefer the
+      second notebook ("Notebook B"), negative values the first one ("Notebook A").
+    - tie_rate: probability of not being able to decide and answering by coin flip. Equal points are always ties.
+    - latency: seconds every comparison takes, to make parallel speedups visible in the wall time.
+    """
+    def __init__(self, points: dict, noise: float = 0.0, position_bias: float = 0.0, tie_rate: float = 0.0,
+                 latency: float = 0.0, seed: int | None = None):
+        self.points = points
+        self.noise = noise
+        self.position_bias = position_bias
+        self.tie_rate = tie_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+
+    def __call__(self, x, y) -> bool:
+        if self.latency:
+            time.sleep(self.latency)
+        r = self.random.random()
+        if r < abs(self.position_bias):
+            return self.position_bias > 0
+        difference = self.points[y] - self.points[x]
+        if difference == 0 or self.random.random() < self.tie_rate:
+            return self.random.random() < 0.5
+        if self.noise == 0:
+            return difference > 0
+        p_correct = 1 / (1 + math.exp(-abs(difference) / self.noise))
+        return (difference > 0) == (self.random.random() < p_correct)
+
+
+def sample_points(expert_points: list[float], n: int, rng: random.Random) -> dict[str, float]:
+    """Draws n notebooks with points from the expert point list (with replacement if n is larger)."""
+    if n <= len(expert_points):
+        drawn = rng.sample(expert_points, n)
+    else:
+        drawn = [rng.choice(expert_points) for _ in range(n)]
+    return {f"nb{i:03d}": p for i, p in enumerate(drawn)}
+
+
+def top_k_precision(top: list, points: dict, k: int) -> float:
+    """Fraction of the selected k notebooks that have at least the points of the true k-th best notebook."""
+    threshold = sorted(points.values())[-k]
+    return sum(points[x] >= threshold for x in top[-k:]) / k
+
+
+def run_once(name: str, order: list, points: dict, comparator: SimulatedComparator, k: int,
+             max_concurrency: int) -> tuple[dict, list]:
+    """Row of the run without the ranking metrics, which benchmark() computes for all runs at once, and the result."""
+    counter = CountingComparator(comparator)
+    start = time.perf_counter()
+    if name in PARALLEL_ALGORITHMS:
+        batch = BatchComparator(counter, max_concurrency)
+        result = PARALLEL_ALGORITHMS[name](order, batch)
+        rounds = batch.rounds
+    elif name in TOP_K_ALGORITHMS:
+        result = TOP_K_ALGORITHMS[name](order, counter, k=k)
+        rounds = None
+    else:
+        result = SEQUENTIAL_ALGORITHMS[name](order, counter)
+        rounds = None
+    wall_time = time.perf_counter() - start
+
+    row = {
+        'algorithm': name,
+        'comparisons': counter.count,
+        'rounds': rounds if rounds is not None else counter.count,
+        'wall_time': wall_time,
+        'top_k_precision': top_k_precision(result, points, k),
+    }
+    return row, result
+
+
+def benchmark(expert_points: list[float], sizes: list[int], algorithms: list[str], noise_levels: list[float],
+              position_bias: float = 0.0, tie_rate: float = 0.0, repetitions: int = 10, k: int = 5,
+              latency: float = 0.0, max_concurrency: int = 8, seed: int = 2797) -> pd.DataFrame:
+    """Runs all combinations and returns one row per run."""
+    rows, results, gains = [], [], []
+    for n in sizes:
+        for noise in noise_levels:
+            for repetition in range(repetitions):
+                rng = random.Random(hash((seed, n, noise, repetition)))
+                points = sample_points(expert_points, n, rng)
+                order = list(points)
+                rng.shuffle(order)
+                for name in algorithms:
+                    # same seed for all algorithms, so they face the same notebooks and the same noise
+                    comparator = SimulatedComparator(points, noise, position_bias, tie_rate, latency,
+                                                     seed=hash((seed, n, noise, repetition)))
+                    row, result = run_once(name, order, points, comparator, min(k, n), max_concurrency)
+                    rows.append({'n': n, 'noise': noise, 'repetition': repetition, **row})
+                    results.append(result)
+                    gains.append(list(points.values()))
+    runs = pd.DataFrame(rows)
+
+    # the rankings of all runs with the same number of notebooks are evaluated in one vectorised call
+    for n in sizes:
+        selected = np.flatnonzero(runs['n'].to_numpy() == n)
+        ranks = rank_matrix([results[i] for i in selected], [f"nb{i:03d}" for i in range(n)])
+        points = np.array([gains[i] for i in selected], dtype=float)
+        runs.loc[selected, 'kendall_tau'] = kendall_tau(ranks, points)
+        runs.loc[selected, 'ndcg'] = ndcg(ranks, points)
+    runs.loc[runs['algorithm'].isin(list(TOP_K_ALGORITHMS)), ['kendall_tau', 'ndcg']] = np.nan
+    return runs
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    return results.groupby(['n', 'noise', 'algorithm']).agg(
+        comparisons=('comparisons', 'mean'),
+        rounds=('rounds', 'mean'),
+        wall_time=('wall_time', 'mean'),
+        kendall_tau=('kendall_tau', 'mean'),
+        ndcg=('ndcg', 'mean'),
+        top_k_precision=('top_k_precision', 'mean'),
+    ).round(3)
+
+
+if __name__ == "__main__":
+    all_algorithms = [*SEQUENTIAL_ALGORITHMS, *PARALLEL_ALGORITHMS, *TOP_K_ALGORITHMS]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', nargs='+', default=['./data/test-data/photosynthese.csv'],
+                        help='expert ranking csv files with a total_points column')
+    parser.add_argument('--n', nargs='+', type=int, default=[10, 20, 35], help='numbers of notebooks')
+    parser.add_argument('--algorithms', nargs='+', default=all_algorithms, choices=all_algorithms)
+    parser.add_argument('--noise', nargs='+', type=float, default=[0.0, 2.0, 5.0],
+                        help='noise scales in points')
+    parser.add_argument('--position-bias', type=float, default=0.0)
+    parser.add_argument('--tie-rate', type=float, default=0.0)
+    parser.add_argument('--repetitions', type=int, default=10)
+    parser.add_argument('--k', type=int, default=5, help='k for top-k algorithms and top-k precision')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per comparison')
+    parser.add_argument('--max-concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=2797)
+    parser.add_argument('--output', help='csv file for the results of all runs')
+    args = parser.parse_args()
+
+    expert_points = [p for path in args.csv for p in pd.read_csv(path)['total_points'].tolist()]
+    results = benchmark(expert_points, args.n, args.algorithms, args.noise, args.position_bias, args.tie_rate,
+                        args.repetitions, args.k, args.latency, args.max_concurrency, args.seed)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summarize(results))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from configparser import ConfigParser
+
+from logs import current_experiment, global_logger as logging
+
+
+def _as_serializable(obj):
+    """Fallback for json.dumps, e.g. for azure.ai.inference models."""
+    if hasattr(obj, "as_dict"):
+        return obj.as_dict()
+    return str(obj)
+
+
+class ComparisonCache:
+    """Disk-backed cache for LLM responses of pairwise comparisons.
+
+    Responses are stored in a SQLite database and looked up by a hash of everything that determines the
+    request: rendered prompt, model, provider, temperature and the index of the vote in majority voting.
+    Hits and misses are counted per experiment (see logs.current_experiment), as the cache is shared by all
+    experiments of the process.
+    """
+    _instances: dict[str, "ComparisonCache"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, max_entries: int | None = None, max_age_days: float | None = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # connection is shared between threads, access is serialized with self._lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self._db.commit()
+        self.evict()
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "ComparisonCache | None":
+        """Returns the cache of the optional [Cache] section, shared by all experiments of this process that use
+        the same path. Returns None if caching is disabled."""
+        if not config.getboolean('Cache', 'enabled', fallback=True):
+            return None
+        path = config.get('Cache', 'path', fallback='./experiments/cache/comparisons.sqlite')
+        max_entries = config.getint('Cache', 'max_entries', fallback=100_000)
+        max_age_days = config.getfloat('Cache', 'max_age_days', fallback=90)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path, max_entries=max_entries, max_age_days=max_age_days)
+            return cls._instances[path]
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """SHA-256 over all request parameters; parameter order does not matter."""
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses[current_experiment.get()] += 1
+                return None
+            self.hits[current_experiment.get()] += 1
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(response, default=_as_serializable), now, now))
+            self._db.commit()
+
+    def evict(self) -> int:
+        """Removes entries older than max_age_days and the least recently used entries beyond max_entries."""
+        removed = 0
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+                removed += self._db.execute("DELETE FROM responses WHERE created < ?", (cutoff,)).rowcount
+            if self.max_entries is not None:
+                removed += self._db.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )""", (self.max_entries,)).rowcount
+            self._db.commit()
+        if removed:
+            logging.info(f"Evicted {removed} entries from comparison cache '{self.path}'.")
+        return removed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> str:
+        """Hits and misses of the current experiment."""
+        experiment = current_experiment.get()
+        with self._lock:
+            hits, misses = self.hits[experiment], self.misses[experiment]
+        total = hits + misses
+        hit_rate = hits / total if total else 0.0
+        return f"Comparison cache: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate), {len(self)} entries."
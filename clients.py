@@ -0,0 +1,238 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from collections import defaultdict
+from configparser import ConfigParser
+
+import httpx
+from azure.ai.inference import ChatCompletionsClient
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AsyncioRequestsTransport, RequestsTransport
+from dotenv import load_dotenv
+
+from logs import current_experiment, global_logger as logging
+from ratelimit import RetryScheduler
+
+
+class PooledHTTPClient:
+    """Shared asynchronous HTTP client with connection pooling and keep-alive.
+
+    The httpx.AsyncClient lives on a background event loop, so that connections are reused across all
+    comparisons independent of the thread issuing them. Synchronous callers use post(), which blocks until
+    the request running on the event loop has finished.
+    """
+    def __init__(self, pool_size: int = 16, keepalive_expiry: float = 60.0, timeout: float = 120.0):
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "PooledHTTPClient":
+        return cls(
+            pool_size=config.getint('HTTP', 'pool_size', fallback=16),
+            keepalive_expiry=config.getfloat('HTTP', 'keepalive_expiry', fallback=60.0),
+            timeout=config.getfloat('HTTP', 'timeout', fallback=120.0),
+        )
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="http-client-loop", daemon=True).start()
+                self._client = asyncio.run_coroutine_threadsafe(self._create_client(), self._loop).result()
+                logging.debug(f"Started pooled HTTP client with {self.pool_size=}, {self.keepalive_expiry=}.")
+        return self._loop
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        # the client has to be created on the loop it is used on
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=self.timeout,
+        )
+
+    async def apost(self, url: str, headers: dict | None = None, json: dict | None = None,
+                    timeout: float | None = None) -> httpx.Response:
+        """POST request on the shared connection pool. Runs on the client's event loop, see submit().
+        The time until the response headers arrived is stored in response.extensions["time_to_first_byte"]."""
+        start = time.perf_counter()
+        request = self._client.build_request("POST", url, headers=headers, json=json, timeout=timeout or self.timeout)
+        response = await self._client.send(request, stream=True)
+        response.extensions["time_to_first_byte"] = time.perf_counter() - start
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        return response
+
+    async def apost_stream(self, url: str, on_line, headers: dict | None = None, json: dict | None = None,
+                           timeout: float | None = None) -> httpx.Response:
+        """POST request whose response body is passed line by line to on_line, e.g. the server-sent events of a
+        streamed completion. As soon as on_line returns True, the response is closed without reading the rest.
+        on_line runs on the client's event loop and has to be fast. Error responses are read completely."""
+        start = time.perf_counter()
+        request = self._client.build_request("POST", url, headers=headers, json=json, timeout=timeout or self.timeout)
+        response = await self._client.send(request, stream=True)
+        response.extensions["time_to_first_byte"] = time.perf_counter() - start
+        try:
+            if response.status_code == 200:
+                async for line in response.aiter_lines():
+                    if on_line(line):
+                        break
+            else:
+                await response.aread()
+        finally:
+            await response.aclose()
+        return response
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedules a coroutine (e.g. from apost()) on the client's event loop."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started())
+
+    def post(self, url: str, headers: dict | None = None, json: dict | None = None,
+             timeout: float | None = None) -> httpx.Response:
+        """Synchronous wrapper around apost()."""
+        return self.submit(self.apost(url, headers, json, timeout)).result()
+
+    def post_stream(self, url: str, on_line, headers: dict | None = None, json: dict | None = None,
+                    timeout: float | None = None) -> httpx.Response:
+        """Synchronous wrapper around apost_stream()."""
+        return self.submit(self.apost_stream(url, on_line, headers, json, timeout)).result()
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+            self._client = None
+
+
+def resolve_credentials(provider: str, model: str) -> tuple[str | None, str | None]:
+    """Returns (api_key, endpoint) for the provider from the environment."""
+    match provider:
+        case "Azure":
+            if model == "Llama-3.3-70B-Instruct":
+                return os.getenv("AZURE_API_KEY"), os.getenv("AZURE_API_ENDPOINT")
+            return os.getenv("AZUREAI_ENDPOINT_KEY"), os.getenv("AZURE_INFERENCE_SDK_ENDPOINT")
+        case "KISSKI":
+            return os.getenv("KISSKI_API_KEY"), os.getenv("KISSKI_API_ENDPOINT")
+        case "LFI":
+            return os.getenv("LFI_API_KEY"), os.getenv("LFI_API_ENDPOINT")
+        case _:
+            logging.warning(f"Provider '{provider}' not supported. Fallback to API_ENDPOINT.")
+            return os.getenv("API_KEY"), os.getenv("API_ENDPOINT")
+
+
+class ProviderClients:
+    """Registry of provider clients, each built once and shared by all comparisons.
+
+    Holds the pooled HTTP client for OpenAI-compatible endpoints, the (sync and async) Azure
+    ChatCompletionsClient per model, the retry scheduler with its per-provider rate limits and per-provider
+    connection statistics. The statistics are kept per experiment (see logs.current_experiment), as the clients
+    are shared by all experiments of the process. The environment is read once.
+    """
+    _shared: dict[tuple, "ProviderClients"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, http_client: PooledHTTPClient, scheduler: RetryScheduler | None = None,
+                 azure_timeout: float = 600):
+        load_dotenv()
+        self.http = http_client
+        self.scheduler = scheduler or RetryScheduler()
+        self.azure_timeout = azure_timeout
+        self._credentials: dict[tuple[str, str], tuple[str | None, str | None]] = {}
+        self._azure_clients: dict[str, ChatCompletionsClient] = {}
+        self._azure_async_clients: dict[str, AsyncChatCompletionsClient] = {}
+        self._lock = threading.Lock()
+        # experiment -> provider -> statistics
+        self.stats: dict[str | None, dict[str, dict[str, float]]] = defaultdict(lambda: defaultdict(
+            lambda: {"clients_created": 0, "requests": 0, "errors": 0, "seconds": 0.0}))
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "ProviderClients":
+        return cls(
+            PooledHTTPClient.from_config(config),
+            RetryScheduler.from_config(config),
+            azure_timeout=config.getfloat('HTTP', 'azure_timeout', fallback=600),
+        )
+
+    @classmethod
+    def shared(cls, config: ConfigParser) -> "ProviderClients":
+        """Returns the clients for the [HTTP] and [RateLimit] settings of config, shared by all experiments of this
+        process with the same settings, so that they use the same connection pools and per-provider rate limits."""
+        key = tuple((section, tuple(sorted(config[section].items())))
+                    for section in ('HTTP', 'RateLimit') if config.has_section(section))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls.from_config(config)
+            return cls._shared[key]
+
+    def credentials(self, provider: str, model: str) -> tuple[str | None, str | None]:
+        with self._lock:
+            if (provider, model) not in self._credentials:
+                self._credentials[(provider, model)] = resolve_credentials(provider, model)
+            return self._credentials[(provider, model)]
+
+    def azure(self, model: str) -> ChatCompletionsClient:
+        """Synchronous Azure inference client for the model, sharing one transport and its connections."""
+        with self._lock:
+            if model not in self._azure_clients:
+                # transport needed to specify a timeout
+                transport = RequestsTransport(connection_timeout=self.azure_timeout, read_timeout=self.azure_timeout)
+                self._azure_clients[model] = ChatCompletionsClient(
+                    endpoint=os.environ["AZURE_INFERENCE_SDK_ENDPOINT"],
+                    credential=AzureKeyCredential(os.environ["AZUREAI_ENDPOINT_KEY"]),
+                    model=model,
+                    transport=transport,
+                )
+                self.stats[current_experiment.get()]["Azure"]["clients_created"] += 1
+            return self._azure_clients[model]
+
+    def azure_async(self, model: str) -> AsyncChatCompletionsClient:
+        """Asynchronous Azure inference client for the model. Its coroutines have to run via self.http.submit()."""
+        with self._lock:
+            if model not in self._azure_async_clients:
+                transport = AsyncioRequestsTransport(connection_timeout=self.azure_timeout, read_timeout=self.azure_timeout)
+                self._azure_async_clients[model] = AsyncChatCompletionsClient(
+                    endpoint=os.environ["AZURE_INFERENCE_SDK_ENDPOINT"],
+                    credential=AzureKeyCredential(os.environ["AZUREAI_ENDPOINT_KEY"]),
+                    model=model,
+                    transport=transport,
+                )
+                self.stats[current_experiment.get()]["Azure"]["clients_created"] += 1
+            return self._azure_async_clients[model]
+
+    def record(self, provider: str, seconds: float, error: bool = False):
+        with self._lock:
+            stats = self.stats[current_experiment.get()][provider]
+            stats["requests"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+
+    def stats_summary(self) -> str:
+        """Statistics of the current experiment."""
+        lines = []
+        with self._lock:
+            for provider, stats in self.stats[current_experiment.get()].items():
+                mean = stats["seconds"] / stats["requests"] if stats["requests"] else 0.0
+                lines.append(f"{provider}: {stats['requests']} requests, {stats['errors']} errors, "
+                             f"{stats['clients_created']} clients created, {mean:.2f}s mean request time")
+        return "Provider connection stats:\n" + "\n".join(lines)
+
+    def close(self):
+        for client in self._azure_clients.values():
+            client.close()
+        for client in self._azure_async_clients.values():
+            self.http.submit(client.close()).result()
+        self.http.close()
@@ -0,0 +1,138 @@
+"""Vectorised evaluation of LLM rankings against the expert points.
+
+The rankings of many runs (seeds, initial orders, experiments) are stacked into one array of shape
+(runs, notebooks) holding the rank of every notebook in the ascending order of a run (0 = worst, best last) and
+NaN for notebooks that a partial ranking did not place. The points have the shape (notebooks,) or (runs, notebooks).
+All metrics are computed for all runs in one call and return one value per run.
+
+    runs = load_events("experiments/events/*.jsonl", "sorting_finished")
+    ranks = rank_matrix(runs["final_order"], points.index, runs["ranked"])
+    evaluate(ranks, points.to_numpy(), n_resamples=1000)
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+
+def rank_matrix(orders, ids, ranked=None) -> np.ndarray:
+    """Ranks of the notebooks ids in every ascending order, shape (len(orders), len(ids)). Notebooks that are missing
+    in an order get NaN, notebooks of an order that are not in ids are ignored. ranked holds for every order the
+    notebooks placed by a partial ranking (e.g. the 'ranked' of the sorting_finished event) or None, the other
+    notebooks of a partial ranking get NaN as well."""
+    index = pd.Index(ids)
+    ranks = np.full((len(orders), len(index)), np.nan)
+    for run, order in enumerate(orders):
+        columns = index.get_indexer(list(order))
+        found = columns >= 0
+        ranks[run, columns[found]] = np.flatnonzero(found)
+    for run, placed in enumerate(ranked if ranked is not None else []):
+        if isinstance(placed, (list, tuple)):
+            ranks[run, ~index.isin(placed)] = np.nan
+    return ranks
+
+
+def _stack(ranks, points) -> tuple[np.ndarray, np.ndarray]:
+    x = np.atleast_2d(np.asarray(ranks, dtype=float))
+    y = np.broadcast_to(np.asarray(points, dtype=float), x.shape)
+    return x, y
+
+
+def kendall_tau(ranks, points) -> np.ndarray:
+    """Kendall's tau-b between ranks and points of every run over the notebooks with a rank. Ties in the points are
+    handled like scipy.stats.kendalltau and DataFrame.corr('kendall')."""
+    x, y = _stack(ranks, points)
+    i, j = np.triu_indices(x.shape[-1], k=1)
+    dx, dy = x[..., i] - x[..., j], y[..., i] - y[..., j]
+    # signs as int8, comparisons with NaN are False, so pairs with a missing value get 0
+    sx, sy = (dx > 0).view(np.int8) - (dx < 0).view(np.int8), (dy > 0).view(np.int8) - (dy < 0).view(np.int8)
+    if np.isnan(x).any() or np.isnan(y).any():
+        valid = ~(np.isnan(dx) | np.isnan(dy))
+        sx, sy = sx * valid, sy * valid
+    denominator = np.sqrt((sx != 0).sum(-1) * (sy != 0).sum(-1))
+    return np.divide((sx * sy).sum(-1), denominator, out=np.full(denominator.shape, np.nan), where=denominator > 0)
+
+
+def spearman(ranks, points) -> np.ndarray:
+    """Spearman's rho between ranks and points of every run over the notebooks with a rank, ties get average ranks."""
+    x, y = _stack(ranks, points)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    count = valid.sum(-1, keepdims=True)
+    # notebooks without rank are ranked after all others and then left out
+    rx, ry = (np.where(valid, rankdata(np.where(valid, v, np.inf), axis=-1), 0.0) for v in (x, y))
+    cx = np.where(valid, rx - rx.sum(-1, keepdims=True) / np.maximum(count, 1), 0.0)
+    cy = np.where(valid, ry - ry.sum(-1, keepdims=True) / np.maximum(count, 1), 0.0)
+    denominator = np.sqrt((cx ** 2).sum(-1) * (cy ** 2).sum(-1))
+    return np.divide((cx * cy).sum(-1), denominator, out=np.full(denominator.shape, np.nan), where=denominator > 0)
+
+
+def ndcg(ranks, points, k: int | None = None, gain: str = "linear") -> np.ndarray:
+    """nDCG@k of every run, with the notebooks from the highest rank (best) down and the points as linear gains,
+    or 2^points - 1 with gain='exponential'. Notebooks without rank are placed last and gain nothing."""
+    assert gain in ["linear", "exponential"], f"Unknown gain '{gain}'."
+    x, y = _stack(ranks, points)
+    gains = np.nan_to_num(2 ** y - 1 if gain == "exponential" else y)
+    order = np.argsort(np.where(np.isnan(x), np.inf, -x), axis=-1, kind="stable")
+    ranked = np.take_along_axis(np.where(np.isnan(x), 0.0, gains), order, axis=-1)[..., :k]
+    ideal = -np.sort(-gains, axis=-1)[..., :k]
+    discounts = 1 / np.log2(np.arange(2, ranked.shape[-1] + 2))
+    dcg, ideal_dcg = ranked @ discounts, ideal @ discounts
+    return np.divide(dcg, ideal_dcg, out=np.zeros(dcg.shape), where=ideal_dcg > 0)
+
+
+def bootstrap(metric, ranks, points, n_resamples: int = 1000, confidence: float = 0.95, seed: int | None = None,
+              **kwargs) -> np.ndarray:
+    """Percentile bootstrap interval of metric (e.g. kendall_tau) for every run, resampling the notebooks with
+    replacement. All runs share the resamples. Returns the lower and upper bounds, shape (runs, 2)."""
+    x, y = _stack(ranks, points)
+    runs, n = x.shape
+    rng = np.random.default_rng(seed)
+    samples = np.empty((runs, n_resamples))
+    # resamples are evaluated in chunks, so that the pairwise differences of hundreds of runs fit into memory
+    chunk = max(1, int(2e7 // (runs * n * n)))
+    for start in range(0, n_resamples, chunk):
+        idx = rng.integers(0, n, size=(min(chunk, n_resamples - start), n))
+        values = metric(x[:, idx].reshape(-1, n), y[:, idx].reshape(-1, n), **kwargs)
+        samples[:, start:start + len(idx)] = values.reshape(runs, len(idx))
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid="ignore"):
+        return np.nanpercentile(samples, [100 * alpha, 100 * (1 - alpha)], axis=-1).T
+
+
+def bootstrap_mean(values, n_resamples: int = 1000, confidence: float = 0.95, seed: int | None = None) -> tuple[float, float, float]:
+    """Mean of values (e.g. the Kendall tau of all runs with different seeds) and its percentile bootstrap interval."""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return np.nan, np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    means = values[rng.integers(0, values.size, size=(n_resamples, values.size))].mean(-1)
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(means, [100 * alpha, 100 * (1 - alpha)])
+    return float(values.mean()), float(low), float(high)
+
+
+def position_bias(ab, ba) -> pd.DataFrame:
+    """Position bias of every run from the results of cmp(a, b) and cmp(b, a) for the same pairs, each of shape
+    (runs, pairs), like position_pairs. Per run the rate of consistent pairs and of the pairs decided for the
+    notebook in position A or B both times."""
+    ab, ba = np.atleast_2d(np.asarray(ab, dtype=bool)), np.atleast_2d(np.asarray(ba, dtype=bool))
+    return pd.DataFrame({
+        "consistent": (ab != ba).mean(-1),
+        "prefers_a": (~ab & ~ba).mean(-1),
+        "prefers_b": (ab & ba).mean(-1),
+    })
+
+
+def evaluate(ranks, points, k=(5, 10), n_resamples: int = 0, confidence: float = 0.95, seed: int | None = None,
+             index=None) -> pd.DataFrame:
+    """One row per run with Kendall tau, Spearman, nDCG and nDCG@k. With n_resamples > 0 also the bootstrap
+    intervals of Kendall tau, Spearman and nDCG in the columns <metric>_low and <metric>_high."""
+    x, y = _stack(ranks, points)
+    results = {"kendall_tau": kendall_tau(x, y), "spearman": spearman(x, y), "ndcg": ndcg(x, y)}
+    for top in k:
+        if top < x.shape[-1]:
+            results[f"ndcg@{top}"] = ndcg(x, y, k=top)
+    if n_resamples:
+        for name, metric in (("kendall_tau", kendall_tau), ("spearman", spearman), ("ndcg", ndcg)):
+            results[f"{name}_low"], results[f"{name}_high"] = bootstrap(metric, x, y, n_resamples, confidence, seed).T
+    return pd.DataFrame(results, index=index)
@@ -1,100 +1,98 @@
+import argparse
 import configparser
+import contextvars
+import functools
 import logging
 import os
-import pathlib
 import random
-import re
-import sys
-from itertools import permutations, combinations
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
 
-import nbformat
-import numpy as np
 import pandas as pd
-from nbformat import NotebookNode
 
+from batch import BATCH_MODES, compare_batch, position_pair_comparisons
+from clients import ProviderClients
 from compare import position_pairs
-from logs import add_file_handler
+from evaluation import evaluate, rank_matrix
+from logs import EventSink, add_event_file, add_experiment_file_handler, current_experiment
 from logs import global_logger as logging
-from llm import PRPmodel
-from sort import heapsort, quicksort, bubble_sort
-from filter import filter_images, filter_output_cells, format_markdown
-
-config = configparser.ConfigParser()
-
-def load_notebooks(directory: str) -> dict[str, NotebookNode]:
-    data: dict[str, NotebookNode] = {}
-
-    for file in pathlib.Path(directory).rglob('*.ipynb'):
-        """Notebook must be named '<exercise>_<hex_id>.ipynb' with <hex_id> matching the notebook id form the csv file."""
-        notebook_hex = re.match(r'.*_([a-fA-F0-9]+)\.ipynb', file.name)
-        if not notebook_hex:
-            logging.warning(f"Notebook {file} does not match the naming convention and will be skipped.")
-            continue
-        notebook_hex = notebook_hex.group(1)
-        with open(file) as f:
-            logging.debug(f"Loading notebook '{file.stem}' with id='{notebook_hex}'")
-            # Reading Notebook as nbformat which is basically like json.read(f) but intended way; main difference
-            # ist that cell contents are not being read as an array of lines but as a string with newlines
-            data[notebook_hex] = nbformat.read(f, as_version=4)
-
-    logging.info(f"Loaded {len(data)} notebooks.")
-    return data
-
-
-def compare_expert_ranking(path: str, check_idxs: list, data_sorted: list) -> pd.DataFrame:
+from journal import ComparisonJournal, config_fingerprint
+from llm import ComparisonError, PRPmodel
+from oracle import ComparisonOracle
+from ranking import IncrementalRanking
+from sort import heapsort, quicksort, bubble_sort, BatchComparator, parallel_heapsort, parallel_quicksort, odd_even_sort, \
+    merge_insertion_sort, binary_insertion_sort, active_ranking, CountingComparator, heap_top_k, quickselect_top_k, \
+    tournament_top_k, select_bottom_k
+from preprocess import PreprocessingCache, load_prompt_texts, preprocessing_options
+
+
+def compare_expert_ranking(config: configparser.ConfigParser, path: str, check_idxs: list, data_sorted: list, ranked: list | None = None) -> pd.DataFrame:
+    """Joins the expert points with the initial and the LLM order. If only a partial order was determined, only
+    the notebooks in ranked get an LLM rank, the others are NaN and ignored in correlations."""
     points: pd.DataFrame = pd.read_csv(path)
 
     df = points.loc[:, ['id', 'total_points']]
 
     if config.getboolean('Data', 'shuffle_notebooks'):
-        df['randomized'] = df['id'].map(lambda x: check_idxs.index(x))
+        df['randomized'] = rank_matrix([check_idxs], df['id'])[0]
     else:
-        df['initial_order'] = df['id'].map(lambda x: check_idxs.index(x))
+        df['initial_order'] = rank_matrix([check_idxs], df['id'])[0]
 
-    df['llm'] = df['id'].map(lambda x: data_sorted[::1].index(x))
+    df['llm'] = rank_matrix([data_sorted], df['id'], [ranked])[0]
     df.set_index('id', inplace=True)
 
     return df
 
-if __name__ == "__main__":
-    if len(sys.argv) <= 1:
-        logging.error("Usage: python execute.py <experiment_config>")
-        exit(1)
-
-    for i in range(1, len(sys.argv)):
-        config_file = sys.argv[i]
-        if os.path.isfile(config_file):
-            try:
-                config.read(config_file)
-                logging.info(f"Starting experiment from config file '{config_file}'")
-            except Exception as e:
-                logging.error(f"Error reading config file: {e}")
-                continue
-        else:
-            logging.error(f"Config file '{config_file}' not found.")
-            continue
-
-        # create separate log file for each experiment
-        experiment_name = config_file.split("/")[-1][:-4]
-        add_file_handler(logging, f'{experiment_name}.log')
-        logging.info(f"Running experiment {experiment_name}.")
-
+def run_experiment(config_file: str, resume: bool = False) -> bool:
+    """Runs the experiment of config_file with its own config, log file and event file. HTTP pools, rate limits
+    and caches are shared with all experiments of this process. With resume, the comparisons recorded in the
+    journal of an earlier, unfinished run are replayed. Returns False if the experiment failed."""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file)
+        logging.info(f"Starting experiment from config file '{config_file}'")
+    except Exception as e:
+        logging.error(f"Error reading config file: {e}")
+        return False
+
+    # create separate log file for each experiment
+    experiment_name = config_file.split("/")[-1][:-4]
+    current_experiment.set(experiment_name)
+    handler = add_experiment_file_handler(logging, f'{experiment_name}.log', experiment_name)
+    try:
+        return _run_experiment(config, config_file, experiment_name, resume)
+    except ComparisonError as e:
+        # no ranking is written from an order with guessed comparisons
+        logging.critical(f"Experiment {experiment_name} aborted: {e} Continue it with --resume once the provider is available.")
+        return False
+    except Exception as e:
+        logging.critical(f"Experiment {experiment_name} failed: {e} {traceback.format_exc()}")
+        return False
+    finally:
+        logging.removeHandler(handler)
+        handler.close()
+
+
+def _run_experiment(config: configparser.ConfigParser, config_file: str, experiment_name: str, resume: bool) -> bool:
+    logging.info(f"Running experiment {experiment_name}.")
+    # structured events of this run next to the text log, see logs.load_events
+    run_start = time.time()
+    events = EventSink()
+    add_event_file(events, f'{experiment_name}.jsonl', f'{experiment_name}@{time.strftime("%Y-%m-%dT%H:%M:%S")}')
+    events.emit("run_start", config_file=config_file, config={s: dict(config[s]) for s in config.sections()})
+
+    prp: PRPmodel | None = None
+    counter: CountingComparator | None = None
+    journal: ComparisonJournal | None = None
+    finished = False
+    try:
         exercise_dir = config['Data']['data_path'] + config['Data']['exercises']
-        notebooks: dict[str, NotebookNode] = load_notebooks(exercise_dir)
-
-        ### Filter
-        if config.getboolean('Data Preprocessing', 'filter_output_images'):
-            notebooks = filter_images(notebooks)
-            logging.info('Images filtered.')
-        if config.getboolean('Data Preprocessing', 'filter_output_cells'):
-            notebooks = filter_output_cells(notebooks)
-            logging.info('Output cells filtered.')
-        match config.get('Data Preprocessing', 'notebook_format', fallback='ipynb-json'):
-            case 'ipynb-json':
-                pass
-            case 'markdown':
-                notebooks = format_markdown(notebooks)
-                logging.info('Markdown formatted.')
+
+        ### Load, filter and format, reusing cached prompt texts of unchanged notebooks
+        preprocessing_cache = PreprocessingCache.from_config(config)
+        notebooks: dict[str, str] = load_prompt_texts(exercise_dir, preprocessing_options(config), preprocessing_cache)
 
         if config.get('Data Preprocessing', 'exclude_notebooks', fallback=None):
             exclude_notebooks = [s.strip().removeprefix("'").removesuffix("'") for s in
@@ -102,15 +100,17 @@ if __name__ == "__main__":
             logging.info(f'Excluding notebooks: {exclude_notebooks}')
             notebooks = {k: v for k, v in notebooks.items() if k not in exclude_notebooks}
 
-        prp = PRPmodel(config, notebooks)
+        prp = PRPmodel(config, notebooks, ProviderClients.shared(config))
+        prp.events = events
 
         random_seed: int | None = config.getint('Data', 'random_seed', fallback=2797)
-        random.seed(random_seed)
+        # own generator per experiment, so that concurrent experiments do not change each other's shuffles
+        rng = random.Random(random_seed)
         logging.info(f'Random seed set to {random_seed}.')
 
         if config.getboolean('Data', 'shuffle_notebooks'):
             check_idxs = list(notebooks.keys())
-            random.shuffle(check_idxs)
+            rng.shuffle(check_idxs)
             logging.info('Notebooks shuffled.')
         elif config.get('Data', 'initial_order', fallback=None):
             check_idxs = [s.strip().removeprefix("'").removesuffix("'") for s in config['Data']['initial_order'].split(',')]
@@ -122,14 +122,43 @@ if __name__ == "__main__":
         ### Sorting and Comparison
         logging.info(f'Starting comparison of notebooks...')
 
+        # with [Comparing] batch, all comparisons are run as one batch first and then answered from its results
+        batch_mode = config.get('Comparing', 'batch', fallback='none')
+        batched = not config.get('Sorting', 'algorithm', fallback=None) and batch_mode in BATCH_MODES
+        batch_results: dict[tuple, bool] = {}
+
+        def batch_result(d1, d2) -> bool:
+            return batch_results[(d1, d2)]
+
         compare_function: callable = None
-        if config.getboolean('Prompting', 'majority_vote'):
+        if batched:
+            compare_function = batch_result
+        elif config.getboolean('Prompting', 'majority_vote'):
             compare_function = prp.llm_majority_vote
         else:
             compare_function = prp.llm_compare
 
+        if prp.prefix_orientation and not batched:
+            # order the notebooks of each pair so that the prompt prefix repeats and can be served from the provider's cache
+            compare_function = prp.prefix_oriented(compare_function)
+
+        # record every outcome, so that the run can be continued with --resume if it dies
+        if config.getboolean('Data', 'journal', fallback=True):
+            journal_path = os.path.join(config.get('Data', 'journal_path', fallback='./experiments/journals/'), f'{experiment_name}.jsonl')
+            compare_function = journal = ComparisonJournal(compare_function, journal_path, config_fingerprint(config), resume)
+
+        # count the comparisons actually sent to the model to relate API cost to ranking quality
+        compare_function = counter = CountingComparator(compare_function)
+
         if config.get('Sorting', 'algorithm', fallback=None):
             algorithm_name: str = config.get('Sorting', 'algorithm')
+            oracle: ComparisonOracle | None = None
+            if config.getboolean('Sorting', 'oracle', fallback=False):
+                # answer already decided pairs without asking the model again
+                compare_function = oracle = ComparisonOracle(
+                    counter,
+                    transitive=config.getboolean('Sorting', 'oracle_transitive', fallback=True),
+                    symmetric=config.getboolean('Sorting', 'oracle_symmetric', fallback=False))
             algorithm: callable = None
             if algorithm_name == 'heapsort':
                 algorithm = heapsort
@@ -137,21 +166,92 @@ if __name__ == "__main__":
                 algorithm = quicksort
             elif algorithm_name == 'bubble_sort':
                 algorithm = bubble_sort
+            elif algorithm_name == 'merge_insertion_sort':
+                algorithm = merge_insertion_sort
+            elif algorithm_name == 'binary_insertion_sort':
+                algorithm = binary_insertion_sort
+            elif algorithm_name == 'heap_top_k':
+                algorithm = heap_top_k
+            elif algorithm_name == 'quickselect_top_k':
+                algorithm = quickselect_top_k
+            elif algorithm_name == 'tournament_top_k':
+                algorithm = tournament_top_k
+            elif algorithm_name == 'active_ranking':
+                algorithm = functools.partial(active_ranking,
+                                              budget=config.getint('Sorting', 'comparison_budget', fallback=None),
+                                              seed=random_seed)
             else:
                 logging.error(f'Unknown sorting algorithm: {algorithm_name}')
-                exit(1)
-
-            logging.info(f'Sorting notebooks with {algorithm_name} using {compare_function.__name__}.')
-            data_sorted = algorithm(check_idxs, compare_function)
-            logging.info(f'Sorting finished. Final order of notebooks: {data_sorted}')
+                return False
+
+            ranked: list | None = None
+            # persisted ranking of the exercise, only new and changed notebooks have to be compared
+            ranking: IncrementalRanking | None = None
+            if config.getboolean('Sorting', 'incremental', fallback=False):
+                ranking = IncrementalRanking.from_config(config)
+            parallel_algorithms = {heapsort: parallel_heapsort, quicksort: parallel_quicksort, bubble_sort: odd_even_sort}
+            if config.getboolean('Sorting', 'parallel', fallback=False) and algorithm not in parallel_algorithms:
+                logging.warning(f'No parallel variant of {algorithm_name}, sorting sequentially.')
+            if algorithm in (heap_top_k, quickselect_top_k, tournament_top_k):
+                if ranking is not None:
+                    logging.warning(f'{algorithm_name} determines only a partial order, which is not kept as incremental ranking.')
+                    ranking = None
+                top_k = config.getint('Sorting', 'top_k', fallback=5)
+                bottom_k = config.getint('Sorting', 'bottom_k', fallback=0)
+                logging.info(f'Selecting the top {top_k} and bottom {bottom_k} notebooks with {algorithm_name} using {compare_function.__name__}.')
+                top = algorithm(check_idxs, compare_function, k=top_k)
+                remaining = [x for x in check_idxs if x not in top]
+                bottom = select_bottom_k(algorithm, remaining, compare_function, k=bottom_k)
+                undetermined = [x for x in remaining if x not in bottom]
+                data_sorted = bottom + undetermined + top
+                ranked = bottom + top
+                logging.info(f'Partial sorting finished. Bottom {bottom_k} notebooks: {bottom}, top {top_k} notebooks: {top}. '
+                             f'The order of the {len(undetermined)} notebooks in between is undetermined.')
+            elif ranking is not None and ranking.order:
+                logging.info(f'Updating the ranking of {ranking.path} by binary insertion using {compare_function.__name__}.')
+                new, changed, removed = ranking.changes(notebooks)
+                data_sorted = ranking.update(notebooks, compare_function, check_idxs)
+                events.emit("ranking_updated", path=ranking.path, new=new, changed=changed, removed=removed,
+                            comparisons=counter.count)
+            elif config.getboolean('Sorting', 'parallel', fallback=False) and algorithm in parallel_algorithms:
+                max_concurrency = config.getint('Sorting', 'max_concurrency', fallback=8)
+                batch_comparator = BatchComparator(compare_function, max_concurrency)
+                logging.info(f'Sorting notebooks with {parallel_algorithms[algorithm].__name__} using {compare_function.__name__} with up to {max_concurrency} concurrent comparisons.')
+                data_sorted = parallel_algorithms[algorithm](check_idxs, batch_comparator)
+                logging.info(f'Sorting took {batch_comparator.rounds} rounds of parallel comparisons.')
+            else:
+                logging.info(f'Sorting notebooks with {algorithm_name} using {compare_function.__name__}.')
+                data_sorted = algorithm(check_idxs, compare_function)
+            if ranked is None:
+                logging.info(f'Sorting finished. Final order of notebooks: {data_sorted}')
+            if ranking is not None:
+                ranking.save(data_sorted, notebooks)
+            # comparisons answered from the comparison cache cost nothing, only the requests reach the model
+            requests, cache_hits = prp.metrics.counters["requests"], prp.metrics.counters["cache_hits"]
+            events.emit("sorting_finished", algorithm=algorithm_name, initial_order=check_idxs,
+                               final_order=data_sorted, ranked=ranked, comparisons=counter.count,
+                               requests=requests, cache_hits=cache_hits)
+            logging.info(f'Sorting used {counter.count} comparisons with {requests} requests to the model '
+                         f'and {cache_hits} answers from the comparison cache.')
+            if oracle is not None:
+                logging.info(oracle.summary())
 
             expert_ranking_csv = config['Data']['data_path'] + config['Data']['expert_ranking']
-            df = compare_expert_ranking(expert_ranking_csv, check_idxs, data_sorted)
+            df = compare_expert_ranking(config, expert_ranking_csv, check_idxs, data_sorted, ranked)
 
             # Compare expert ranking to LLM ranking
             logging.info(f'Expert ranking compared to LLM ranking:')
             logging.info(f'df:\n{df}')
-            logging.info(df.corr(method='kendall'))
+            rank_columns = [column for column in df.columns if column != 'total_points']
+            results = evaluate(df[rank_columns].to_numpy().T, df['total_points'].to_numpy(),
+                               k=[int(k) for k in config.get('Evaluation', 'ndcg_k', fallback='5, 10').split(',')],
+                               n_resamples=config.getint('Evaluation', 'bootstrap_resamples', fallback=1000),
+                               confidence=config.getfloat('Evaluation', 'confidence', fallback=0.95),
+                               seed=random_seed, index=rank_columns)
+            with pd.option_context('display.width', 200, 'display.max_columns', None):
+                logging.info(f'Correlation with the expert points:\n{results.round(3)}')
+            events.emit("expert_correlation", kendall={'total_points': 1.0, **results['kendall_tau'].to_dict()},
+                        evaluation=results.to_dict(orient='index'), ranking=df.reset_index().to_dict(orient='records'))
 
         elif config.get('Comparing', 'algorithm', fallback=None):
             algorithm_name: str = config.get('Comparing', 'algorithm')
@@ -160,25 +260,96 @@ if __name__ == "__main__":
                 algorithm = position_pairs
             else:
                 logging.error(f'Unknown sorting algorithm: {algorithm_name}')
-                exit(1)
+                return False
 
             logging.info(f'Comparing notebook pairs with {algorithm_name} using {compare_function.__name__}.')
 
             all_nb_pairs: list[tuple] = list(combinations(check_idxs, 2))
             n_pairs: int = config.getint('Comparing', 'pairs', fallback=len(all_nb_pairs))
             if config.getboolean('Data', 'shuffle_notebooks'):
-                random.shuffle(all_nb_pairs)
+                rng.shuffle(all_nb_pairs)
 
             selected_nb_pairs: list[tuple] = all_nb_pairs[:n_pairs]
             logging.info(f'Selected {n_pairs} of ouf {len(all_nb_pairs)} notebook pairs for comparison: {selected_nb_pairs}')
 
+            if prp.local is not None and prp.both_orientations:
+                # averaging both orientations would make every pair consistent and hide the position bias
+                logging.info('Scoring each order of the pairs on its own with the local model.')
+                prp.both_orientations = False
+
+            if batched:
+                # all pairs are known upfront, so they are run as one batch instead of one comparison after another,
+                # leaving out the comparisons that are replayed from the journal of an interrupted run
+                comparisons = [c for c in position_pair_comparisons(selected_nb_pairs) if journal is None or not journal.recorded(*c)]
+                if comparisons:
+                    batch_path = os.path.join(config.get('Comparing', 'batch_path', fallback='./experiments/batches/'), experiment_name)
+                    batch_results.update(compare_batch(
+                        prp, comparisons, batch_path, mode=batch_mode,
+                        max_concurrency=config.getint('Comparing', 'max_concurrency', fallback=8),
+                        base_url=config.get('Comparing', 'batch_url', fallback=None),
+                        poll_interval=config.getfloat('Comparing', 'poll_interval', fallback=60)))
+            # the results of a batch are journaled and counted like single comparisons
             consistency_list = algorithm(selected_nb_pairs, compare_function)
             # combine results with selected_nb_pairs
             results = list(zip(selected_nb_pairs, consistency_list))
             logging.info(f'Comparison results: {results}')
             logging.info(f'Consistency list: {consistency_list}')
             logging.info(f'Out of {len(consistency_list)} comparisons made, {sum(consistency_list)} were consistent, meaning the LLM choose one over the other independent of its appearance in the prompt.')
+            events.emit("position_pairs", pairs=selected_nb_pairs, consistent=consistency_list)
 
         else:
             logging.error('No sorting or comparing algorithm specified.')
-            exit(1)
+            return False
+
+        finished = True
+        return True
+    finally:
+        # also for failed and aborted runs, whose metrics show where the time went
+        aborted = not finished
+        if prp is not None:
+            if prp.cache is not None:
+                logging.info(prp.cache.stats())
+            if prp.local is not None:
+                logging.info(prp.local.stats())
+            logging.info(prp.clients.stats_summary())
+            logging.info(prp.scheduler.stats())
+            logging.info(prp.metrics.report())
+            metrics_file = os.path.join(config.get('Data', 'metrics_path', fallback='./experiments/metrics/'), f'{experiment_name}.json')
+            prp.metrics.export(metrics_file, aborted=aborted, wall_time=time.time() - run_start)
+            logging.info(f'Metrics written to {metrics_file}.')
+        events.emit("run_summary", aborted=aborted, wall_time=time.time() - run_start,
+                    comparisons=counter.count if counter is not None else 0,
+                    requests=prp.metrics.counters["requests"] if prp is not None else 0,
+                    cache_hits=prp.metrics.counters["cache_hits"] if prp is not None else 0)
+        if journal is not None:
+            if journal.replayed:
+                logging.info(f'{journal.replayed} comparisons were replayed from the journal of the interrupted run.')
+            journal.close()
+        events.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the experiments configured in the given .ini files.")
+    parser.add_argument("configs", nargs="+", metavar="experiment_config")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of experiments running at the same time, sharing HTTP pools, rate limits and caches")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted experiments by replaying the comparisons of their journals")
+    args = parser.parse_args()
+
+    config_files = []
+    for config_file in args.configs:
+        if os.path.isfile(config_file):
+            config_files.append(config_file)
+        else:
+            logging.error(f"Config file '{config_file}' not found.")
+
+    if args.jobs > 1:
+        logging.info(f"Running {len(config_files)} experiments with up to {args.jobs} at the same time.")
+    # every experiment runs in a copy of the current context, so that its log records are routed to its log file
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_experiment, f, args.resume) for f in config_files]
+        succeeded = [future.result() for future in futures]
+
+    if len(config_files) < len(args.configs) or not all(succeeded):
+        exit(1)
@@ -1,37 +1,113 @@
-from copy import deepcopy
-import nbformat
+import json
+import threading
+
 from nbconvert import MarkdownExporter
+from nbformat import NotebookNode
+
+# Filters are per-cell transforms: they get a cell and return either the same cell object or a shallow copy with
+# the changed fields replaced. Unchanged parts, especially large output payloads, are shared and never copied.
+
+
+def remove_images(cell: NotebookNode) -> NotebookNode:
+    """Sets the image data to None in the output of a code cell."""
+    if cell['cell_type'] != 'code' or not any('data' in o and 'image/png' in o['data'] for o in cell.get('outputs', [])):
+        return cell
+    outputs = [
+        NotebookNode({**output, 'data': NotebookNode({**output['data'], 'image/png': None})})
+        if 'data' in output and 'image/png' in output['data'] else output
+        for output in cell['outputs']
+    ]
+    return NotebookNode({**cell, 'outputs': outputs})
+
+
+def remove_outputs(cell: NotebookNode) -> NotebookNode:
+    """Removes the output of a code cell."""
+    if cell['cell_type'] != 'code' or 'outputs' not in cell:
+        return cell
+    return NotebookNode({**cell, 'outputs': []})
+
+
+def truncate_outputs(max_chars: int):
+    """Returns a cell filter that shortens text outputs of code cells to max_chars, keeping beginning and end."""
+    def _shorten(text: str) -> str:
+        if len(text) <= max_chars:
+            return text
+        marker = f"\n[... {len(text) - max_chars} characters truncated ...]\n"
+        return text[:max_chars // 2] + marker + text[len(text) - (max_chars - max_chars // 2):]
+
+    def _truncate_output(output: NotebookNode) -> NotebookNode:
+        if isinstance(output.get('text'), str) and len(output['text']) > max_chars:
+            output = NotebookNode({**output, 'text': _shorten(output['text'])})
+        if 'data' in output and any(isinstance(v, str) and len(v) > max_chars and k.startswith('text/')
+                                    for k, v in output['data'].items()):
+            data = {k: _shorten(v) if isinstance(v, str) and k.startswith('text/') else v
+                    for k, v in output['data'].items()}
+            output = NotebookNode({**output, 'data': NotebookNode(data)})
+        return output
+
+    def _truncate_outputs(cell: NotebookNode) -> NotebookNode:
+        if cell['cell_type'] != 'code' or not cell.get('outputs'):
+            return cell
+        outputs = [_truncate_output(output) for output in cell['outputs']]
+        if all(new is old for new, old in zip(outputs, cell['outputs'])):
+            return cell
+        return NotebookNode({**cell, 'outputs': outputs})
+
+    return _truncate_outputs
+
+
+def apply_filters(notebook: NotebookNode, filters: list) -> NotebookNode:
+    """Applies all cell filters in a single pass over the cells of the notebook."""
+    if not filters:
+        return notebook
+    cells = []
+    for cell in notebook['cells']:
+        for cell_filter in filters:
+            cell = cell_filter(cell)
+        cells.append(cell)
+    return NotebookNode({**notebook, 'cells': cells})
+
+
+_markdown_exporter: MarkdownExporter | None = None
+_markdown_lock = threading.Lock()
+
+
+def to_markdown(notebook: NotebookNode) -> str:
+    """Converts the notebook to markdown, reusing one exporter instead of loading its templates for every notebook."""
+    global _markdown_exporter
+    with _markdown_lock:
+        if _markdown_exporter is None:
+            _markdown_exporter = MarkdownExporter()
+        markdown, _ = _markdown_exporter.from_notebook_node(notebook)
+    return markdown
+
+
+def to_minimal_json(notebook: NotebookNode) -> str:
+    """Serializes the notebook as JSON without whitespace between tokens."""
+    return json.dumps(notebook, separators=(',', ':'), ensure_ascii=False)
+
+
+def to_code_markdown(notebook: NotebookNode) -> str:
+    """Only the sources of the markdown and code cells, without metadata and outputs."""
+    language = notebook.get('metadata', {}).get('language_info', {}).get('name', 'python')
+    parts = []
+    for cell in notebook['cells']:
+        if cell['cell_type'] == 'markdown':
+            parts.append(cell['source'])
+        elif cell['cell_type'] == 'code':
+            parts.append(f"```{language}\n{cell['source']}\n```")
+    return "\n\n".join(parts)
+
+
+NOTEBOOK_FORMATS = {
+    'ipynb-json': str,
+    'minimal-json': to_minimal_json,
+    'markdown': to_markdown,
+    'code-markdown': to_code_markdown,
+}
+
 
-def filter_images(data_array):
-    """Sets the image data to None in the output of code cells."""
-    data = deepcopy(data_array)
-    for k, v in data.items():
-        for cell in v['cells']:
-            if cell['cell_type'] == 'code' and 'outputs' in cell:
-                for output in cell['outputs']:
-                    if 'data' in output and 'image/png' in output['data']:
-                        # remove image from data
-                        output['data']['image/png'] = None
-    return data
-
-def filter_output_cells(data_array):
-    """Removes the output of code cells."""
-    data = deepcopy(data_array)
-    for k, v in data.items():
-        for i, cell in enumerate(v['cells']):
-            if cell['cell_type'] == 'code' and 'outputs' in cell:
-                #print(cell['outputs'])
-                data[k]['cells'][i]['outputs'] = []
-    return data
-
-
-
-def format_markdown(data_array):
-    """Formats the markdown cells."""
-    data = {}
-
-    for k, v in data_array.items():
-        markdown, _ = MarkdownExporter().from_notebook_node(v)
-        data[k] = markdown
-
-    return data
\ No newline at end of file
+def render_notebook(notebook: NotebookNode, filters: list, notebook_format: str = 'ipynb-json') -> str:
+    """Filters the notebook and renders the text that is inserted into the prompt in one of NOTEBOOK_FORMATS."""
+    notebook = apply_filters(notebook, filters)
+    return NOTEBOOK_FORMATS.get(notebook_format, str)(notebook)
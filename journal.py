@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict, deque
+from configparser import ConfigParser
+
+from logs import global_logger as logging
+
+
+def config_fingerprint(config: ConfigParser) -> str:
+    """Hash of all settings, so that a journal is only replayed by the experiment that wrote it."""
+    serialized = json.dumps({s: dict(config[s]) for s in config.sections()}, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ComparisonJournal:
+    """
+    Wraps a comparison function and appends every outcome to a JSONL journal, one line per comparison.
+
+    The sorting algorithms are deterministic given the initial order and the outcomes of the comparisons. So a
+    run that died can be resumed by replaying the journal: comparisons found in the journal are answered with
+    the recorded outcome in the order they were recorded, the first unknown one continues with the model.
+    Outcomes are looked up by pair, so the replay also works for parallel algorithms whose comparisons finish in
+    a different order.
+
+    :param cmp: Comparison function (Lambda) that compares two elements.
+    :param path: File of the journal.
+    :param fingerprint: Identifies the settings of the experiment, see config_fingerprint().
+    :param resume: Replay an existing journal with the same fingerprint instead of starting a new one.
+    """
+    def __init__(self, cmp, path: str, fingerprint: str, resume: bool = False):
+        self.cmp = cmp
+        self.path = path
+        self.__name__ = getattr(cmp, '__name__', type(cmp).__name__)
+        self.replayed = 0
+        self._recorded: dict[tuple, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+
+        if resume and os.path.isfile(path):
+            self._load(fingerprint)
+        else:
+            if resume:
+                logging.warning(f"No journal found at {path}, starting from the beginning.")
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self, fingerprint: str):
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.readlines()
+        header = json.loads(lines[0]) if lines else {}
+        if header.get("fingerprint") != fingerprint:
+            raise ValueError(f"Journal {self.path} was written with different settings and cannot be resumed.")
+        valid = lines[:1]
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break  # last line was cut off when the run died
+            self._recorded[(entry["x"], entry["y"])].append(entry["result"])
+            valid.append(line if line.endswith("\n") else line + "\n")
+        if valid != lines:
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.writelines(valid)
+        logging.info(f"Loaded {sum(len(r) for r in self._recorded.values())} comparisons from journal {self.path}.")
+
+    def recorded(self, x, y) -> bool:
+        """Whether the outcome of cmp(x, y) is in the journal and will be replayed."""
+        with self._lock:
+            return bool(self._recorded.get((x, y)))
+
+    def __call__(self, x, y) -> bool:
+        with self._lock:
+            if self._recorded[(x, y)]:
+                self.replayed += 1
+                return self._recorded[(x, y)].popleft()
+
+        result = self.cmp(x, y)
+
+        with self._lock:
+            self._file.write(json.dumps({"x": x, "y": y, "result": result}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return result
+
+    def close(self):
+        with self._lock:
+            self._file.close()
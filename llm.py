@@ -1,31 +1,43 @@
 #!/usr/bin/env python3
+import contextvars
+import itertools
 import re
+import threading
 import traceback
-import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+import httpx
 from nbformat import NotebookNode
 
-import os
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
 from azure.ai.inference.models import SystemMessage, UserMessage
-from azure.core.pipeline.transport import RequestsTransport
-from dotenv import load_dotenv
+from azure.core.exceptions import HttpResponseError
 
-from logs import global_logger as logging
+from cache import ComparisonCache
+from clients import ProviderClients
+from local import LocalScorer
+from metrics import Metrics
+from logs import EventSink, global_events, global_logger as logging
+from ratelimit import RetryScheduler
+from streaming import StreamedCompletion
+import tokens
+
+
+class ComparisonError(Exception):
+    """A comparison could not be decided, e.g. because the retries or the retry budget are exhausted. Aborts the
+    experiment instead of assuming an order, the comparisons made so far are kept in the journal."""
 
 
 class PRPmodel:
     """Pairwise Ranking Prompting model configuration."""
-    def __init__(self, config: ConfigParser, data: dict[str, NotebookNode]):
-        self.API_KEY = os.getenv("API_KEY")
-        self.API_ENDPOINT = os.getenv("API_ENDPOINT")
-
+    def __init__(self, config: ConfigParser, data: dict[str, NotebookNode | str], clients: ProviderClients | None = None):
         self.system_prompt = config['Prompting']['system_prompt']
         self.user_prompt_template = config['Prompting']['user_prompt_template']
         self.majority_vote = config['Prompting'].getboolean('majority_vote', False)
         self.votes = config['Prompting'].getint('votes', 1)
+        self.parallel_votes = config['Prompting'].getboolean('parallel_votes', False)
+        self.n_completions = config['Prompting'].getboolean('n_completions', False)
+        self.prefix_orientation = config['Prompting'].getboolean('prefix_orientation', False)
 
         self.model = config['Model']['model']
         self.provider = config['Model']['provider']
@@ -33,30 +45,175 @@ class PRPmodel:
         self.initial_temperature = config['Model'].getfloat('initial_temperature', 0.1)
         self.temperature_increase_on_error = config['Model'].getfloat('temperature_increase_on_error', 0.1)
         self.max_retries = config['Model'].getint('max_retries', 10)
+        self.keep_alive: str | None = config['Model'].get('keep_alive', None)
+        self.stream = config['Model'].getboolean('stream', False)
+        self.use_tokenizer = config['Model'].getboolean('tokenizer', True)
+        self.context_window: int | None = config['Model'].getint('context_window', tokens.MODEL_CONTEXT_WINDOWS.get(self.model))
+        # opt-in, so that experiments without the setting keep their full prompts and stay comparable
+        self.truncation = config['Model'].get('truncation', 'none')
+        assert self.truncation in ["largest", "none"], f"Unknown truncation '{self.truncation}'."
 
 
         self.dataset = data
-
-        assert self.provider in ["Azure", "KISSKI", "LFI"]
+        # every notebook is rendered to its prompt text only once and not on every comparison
+        self.prompts: dict[str, str] = {k: v if isinstance(v, str) else str(v) for k, v in data.items()}
+        self.prompt_tokens: dict[str, int] = {k: self.count_tokens(v) for k, v in self.prompts.items()}
+        if self.prompt_tokens:
+            logging.info(f"Prepared prompt texts of {len(self.prompts)} notebooks with "
+                         f"{min(self.prompt_tokens.values())} to {max(self.prompt_tokens.values())} tokens.")
+        # tokens of system prompt and user prompt template without notebooks
+        self.prompt_overhead: int = self.count_tokens(self.system_prompt) + self.count_tokens(
+            self.user_prompt_template.format(nb1="", nb2=""))
+        self._truncated: dict[tuple[str, int], str] = {}
+        # tokens left for both notebooks in the context window; the local model only scores the next token
+        output_tokens = 0 if self.provider == "Local" else self.max_output_tokens
+        self.notebook_budget: int | None = None
+        if self.context_window is not None:
+            self.notebook_budget = self.context_window - output_tokens - self.prompt_overhead
+            assert self.notebook_budget > 0, (
+                f"No tokens left for the notebooks in the context window of {self.context_window} tokens of "
+                f"'{self.model}' after {output_tokens} output tokens and {self.prompt_overhead} prompt tokens. "
+                f"Reduce [Model] max_output_tokens or set context_window.")
+        self.cache: ComparisonCache | None = ComparisonCache.from_config(config)
+        self.clients: ProviderClients = clients or ProviderClients.from_config(config)
+        self.azure_async = config.getboolean('HTTP', 'azure_async', fallback=False)
+        self.scheduler: RetryScheduler = self.clients.scheduler
+        self.events: EventSink = global_events
+        self.metrics: Metrics = Metrics()
+        self._local = threading.local()
+        # notebook -> number of the comparison that last contained it, see prefix_oriented
+        self._prefix_recency: dict[str, int] = {}
+        self._prefix_clock = itertools.count()
+        self._prefix_lock = threading.Lock()
+        # (d1, d2, vote) -> number of comparisons of the pair so far, see repeat_index
+        self._repeats: dict[tuple, int] = {}
+        self._repeats_lock = threading.Lock()
+
+        assert self.provider in ["Azure", "KISSKI", "LFI", "Local"]
         if self.provider == "Azure":
             assert self.model in [ "DeepSeek-R1", "Llama-3.3-70B-Instruct" ]
         elif self.provider == "KISSKI":
             assert self.model in [ "DeepSeek-R1", "deepseek-r1-distill-llama-70b", "llama-3.3-70b-instruct", "qwen2.5-coder-32b-instruct", "mistral-large-instruct"]
         elif self.provider == "LFI":
             assert self.model in [ "deepseek-r1:8b", "llama3.1:8b", "gemma2:latest", "phi3:latest" ]
+        elif self.provider == "Local":
+            assert self.model in tokens.MODEL_TOKENIZERS or config.has_option('Local', 'repo'), \
+                f"No Hugging Face repository known for model '{self.model}', set [Local] repo."
         else:
             raise AssertionError(f"Provider '{self.provider}' not supported.")
 
+        # the local backend scores comparisons from next-token logits instead of sending requests, see local.py
+        self.local: LocalScorer | None = LocalScorer.from_config(config) if self.provider == "Local" else None
+        self.both_orientations = config.getboolean('Local', 'both_orientations', fallback=True)
+        if self.local is not None:
+            self.API_KEY, self.API_ENDPOINT = None, None
+            if self.majority_vote:
+                logging.warning("Scores of the local model are deterministic, so every vote of majority voting is the same.")
+        else:
+            self.API_KEY, self.API_ENDPOINT = self.clients.credentials(self.provider, self.model)
+
         if self.majority_vote:
             assert self.initial_temperature >= 0.1, "Majority voting requires at least a 0.1 temperature"
             assert self.votes % 2 == 1, "Majority voting requires an odd number of votes"
 
-    def _send_prompt_openai(self, nb1: str, nb2: str, err_count: int = 0) -> dict:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.API_KEY}"
-        }
+    def _trace(self) -> dict:
+        """Details of the requests of the current comparison in this thread, reported in its event."""
+        if not hasattr(self._local, "trace"):
+            self._reset_trace()
+        return self._local.trace
+
+    def _reset_trace(self):
+        self._local.trace = {"attempts": 0, "cached": False, "prompt_tokens": 0, "completion_tokens": 0,
+                             "cached_tokens": 0, "time_to_verdict": None, "stopped_early": False}
+
+    def _record_request(self, start: float, error: bool = False, time_to_first_byte: float | None = None):
+        seconds = time.perf_counter() - start
+        self.clients.record(self.provider, seconds, error=error)
+        self.metrics.observe("request_seconds", seconds)
+        self.metrics.increment("requests")
+        if error:
+            self.metrics.increment("request_errors")
+        if time_to_first_byte is not None:
+            self.metrics.observe("time_to_first_byte_seconds", time_to_first_byte)
+
+    @staticmethod
+    def cached_tokens(usage) -> int | None:
+        """Prompt tokens served from the provider's prefix cache, if the provider reports them."""
+        details = usage.get("prompt_tokens_details") or {}
+        return details.get("cached_tokens")
+
+    def _record_usage(self, response: dict):
+        usage = response.get("usage") or {}
+        for field in ("prompt_tokens", "completion_tokens"):
+            if usage.get(field) is not None:
+                self.metrics.observe(field, usage[field])
+                self.metrics.increment(f"{field}_total", usage[field])
+        if self.cached_tokens(usage) is not None:
+            self.metrics.observe("cached_tokens", self.cached_tokens(usage))
+            self.metrics.increment("cached_tokens_total", self.cached_tokens(usage))
+
+    def _streamed(self, completion: StreamedCompletion) -> dict:
+        """Response of a streamed completion. If the stream was stopped at the verdict, the usage was not sent
+        and the completion tokens are estimated from the received text."""
+        response = completion.response()
+        if completion.time_to_verdict is not None:
+            self.metrics.observe("time_to_verdict_seconds", completion.time_to_verdict)
+            self._trace()["time_to_verdict"] = completion.time_to_verdict
+        if completion.stopped_early:
+            self.metrics.increment("streams_stopped_early")
+            self._trace()["stopped_early"] = True
+        if "usage" not in response:
+            response["usage"] = {"completion_tokens": sum(self.count_tokens(choice["message"]["content"])
+                                                          for choice in response["choices"]), "estimated": True}
+        return response
+
+    def _retry(self, attempt: int, cause: str, delay: float | None = None) -> bool:
+        """Waits before the next attempt of a request and counts the retry by its cause.
+        Returns False if the retry budget is exhausted."""
+        start = time.perf_counter()
+        retry = self.scheduler.wait(attempt, self.max_retries, delay)
+        self.metrics.observe("backoff_seconds", time.perf_counter() - start)
+        if retry:
+            self.metrics.increment(f"retries.{cause}")
+        return retry
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens of the text for this model. Tokenizers are loaded on first use; without a tokenizer
+        the count is estimated with about four characters per token."""
+        return tokens.count_tokens(self.model if self.use_tokenizer else None, text)
+
+    def _truncate(self, d, max_tokens: int) -> str:
+        if (d, max_tokens) not in self._truncated:
+            self._truncated[(d, max_tokens)] = tokens.truncate_middle(self.prompts[d], max_tokens, self.count_tokens)
+        return self._truncated[(d, max_tokens)]
+
+    def build_pair(self, d1, d2) -> tuple[str, str]:
+        """Prompt texts of both notebooks. If the pair does not fit into the context window together with the
+        prompt and the output tokens, the larger notebook is truncated first, both to half of the budget if needed."""
+        nb1, nb2 = self.prompts[d1], self.prompts[d2]
+        if self.context_window is None:
+            return nb1, nb2
+        budget = self.notebook_budget
+        tokens1, tokens2 = self.prompt_tokens[d1], self.prompt_tokens[d2]
+        if tokens1 + tokens2 <= budget:
+            return nb1, nb2
+        if self.truncation == "none":
+            logging.warning(f"Prompt for {d1} and {d2} with {tokens1 + tokens2} notebook tokens exceeds the budget of {budget} tokens.")
+            return nb1, nb2
+
+        logging.warning(f"Truncating prompt for {d1} and {d2} with {tokens1 + tokens2} notebook tokens to the budget of {budget} tokens.")
+        if tokens1 >= tokens2:
+            nb1 = self._truncate(d1, max(budget - tokens2, budget // 2))
+            if tokens2 > budget - budget // 2:
+                nb2 = self._truncate(d2, budget - budget // 2)
+        else:
+            nb2 = self._truncate(d2, max(budget - tokens1, budget // 2))
+            if tokens1 > budget - budget // 2:
+                nb1 = self._truncate(d1, budget - budget // 2)
+        return nb1, nb2
 
+    def request_data(self, nb1: str, nb2: str, err_count: int = 0, n: int = 1) -> dict:
+        """Body of an OpenAI-compatible chat completion request for the pair (nb1, nb2)."""
         user_msg: str = self.user_prompt_template.format(nb1=nb1, nb2=nb2)
 
         data = {
@@ -68,41 +225,82 @@ class PRPmodel:
             "max_tokens": self.max_output_tokens,
             "temperature": (self.initial_temperature + self.temperature_increase_on_error * err_count),
         }
+        if n > 1:
+            data["n"] = n
+        if self.keep_alive and self.provider == "LFI":
+            # keeps the model and its KV cache loaded in Ollama between requests, so common prefixes are reused
+            data["keep_alive"] = self.keep_alive
+        return data
+
+    def _send_prompt_openai(self, nb1: str, nb2: str, err_count: int = 0, n: int = 1) -> dict:
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.API_KEY}"
+        }
+
+        data = self.request_data(nb1, nb2, err_count, n)
+        if self.stream:
+            data["stream"] = True
+            # the usage comes with the last chunk, which is only received if the stream is not stopped at the verdict
+            data["stream_options"] = {"include_usage": True}
 
         logging.debug(f"Sending prompt: {data}")
 
         for attempt in range(1, self.max_retries + 1):
-            wait_time: int = 2 ** attempt
+            delay: float | None = None  # None: jittered exponential backoff
+            self._trace()["attempts"] += 1
+            self.metrics.observe("queue_seconds", self.scheduler.acquire(self.provider))
+            start = time.perf_counter()
             try:
-                response = requests.post(self.API_ENDPOINT, headers=headers, json=data, timeout=120)
-                logging.debug(f'Response with status_code {response.status_code} "{response.text}"')
+                if self.stream:
+                    # read until the verdict of every choice is known, see streaming.py
+                    completion = StreamedCompletion(n, start)
+                    response = self.clients.http.post_stream(self.API_ENDPOINT, completion.feed_line, headers=headers, json=data)
+                else:
+                    response = self.clients.http.post(self.API_ENDPOINT, headers=headers, json=data)
+                self._record_request(start, response.status_code != 200, response.extensions.get("time_to_first_byte"))
                 if response.status_code == 200:
-                    if response.json()['choices'][0]['finish_reason'] == 'stop':
-                        logging.info(f'Received valid response: {response.json()}')
-                        return response.json()
+                    body = self._streamed(completion) if self.stream else response.json()
+                    logging.debug(f'Response with status_code {response.status_code} "{body}"')
+                    self.scheduler.on_success(self.provider)
+                    self._record_usage(body)
+                    if body['choices'] and all(choice['finish_reason'] == 'stop' for choice in body['choices']):
+                        logging.info(f'Received valid response: {body}')
+                        return body
                     else:
-                        logging.warning(f'Response did not finish correctly. (Maybe limit of {self.max_output_tokens} output tokens was hit?): {response.json()}')
-                        wait_time = 1
+                        logging.warning(f'Response did not finish correctly. (Maybe limit of {self.max_output_tokens} output tokens was hit?): {body}')
+                        cause = "truncated"
+                        delay = 1
                 elif response.status_code == 429:
-                    retry_after = response.headers.get("Retry-After")
-                    if retry_after:
-                        wait_time = int(retry_after)
-                    logging.warning(f"Rate limit hit.")
+                    cause = "rate_limit"
+                    # with a Retry-After the provider's bucket is paused, so no additional backoff is needed
+                    if self.scheduler.on_rate_limit(self.provider, response.headers.get("Retry-After")) is not None:
+                        delay = 0
                 else:
+                    cause = "server_error" if response.status_code >= 500 else "client_error"
                     logging.error(f"Error in response: {response.status_code}, {response.text}.")
-            except requests.exceptions.Timeout:
+            except httpx.TimeoutException:
+                self._record_request(start, error=True)
+                cause = "timeout"
                 logging.warning(f"Request timed out.")
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
+                self._record_request(start, error=True)
+                cause = "connection_error"
                 logging.error(f"Error in request: {e} {traceback.format_exc()}.")
+            except ValueError as e:
+                # a chunk of the stream that is no valid JSON
+                self._record_request(start, error=True)
+                cause = "invalid_response"
+                logging.error(f"Invalid response stream: {e}.")
 
-            logging.info(f"Retrying in {wait_time} seconds... (Attempt {attempt}/{self.max_retries})")
-            time.sleep(wait_time)
+            if attempt == self.max_retries or not self._retry(attempt, cause, delay):
+                break
 
         logging.critical(f"Max retries exceeded. No valid response after {self.max_retries} attempts.")
         return {}
 
 
-    def _send_prompt_azure(self, nb1: str, nb2: str, err_count: int = 0) -> dict:
+    def _send_prompt_azure(self, nb1: str, nb2: str, err_count: int = 0, n: int = 1) -> dict:
         user_msg: str = self.user_prompt_template.format(nb1=nb1, nb2=nb2)
 
         data = {
@@ -117,65 +315,171 @@ class PRPmodel:
 
         logging.debug(f"Sending prompt: {data}")
 
-        # transport needed to specify a timeout
-        transport = RequestsTransport(connection_timeout=600, read_timeout=600)
-
-        client = ChatCompletionsClient(
-            endpoint=os.environ["AZURE_INFERENCE_SDK_ENDPOINT"],
-            credential=AzureKeyCredential(os.environ["AZUREAI_ENDPOINT_KEY"]),
-            model = self.model,
-            transport=transport
-        )
-
         for attempt in range(1, self.max_retries + 1):
-            wait_time: int = 2 ** attempt
+            delay: float | None = None  # None: jittered exponential backoff
+            self._trace()["attempts"] += 1
+            self.metrics.observe("queue_seconds", self.scheduler.acquire(self.provider))
+            start = time.perf_counter()
             try:
-                response = client.complete(
-                    messages=data["messages"],
-                    model = data["model"],
-                    max_tokens=data["max_tokens"],
-                    temperature=data["temperature"],
-                )
+                if self.stream:
+                    completion = StreamedCompletion(n, start)
+                    request = dict(messages=data["messages"], model=data["model"], max_tokens=data["max_tokens"],
+                                   temperature=data["temperature"], model_extras={"n": n} if n > 1 else None)
+                    if self.azure_async:
+                        self.clients.http.submit(self._stream_azure_async(completion, request)).result()
+                    else:
+                        updates = self.clients.azure(self.model).complete(stream=True, **request)
+                        try:
+                            for update in updates:
+                                if completion.feed_chunk(update.as_dict()):
+                                    break
+                        finally:
+                            updates.close()
+                    response = self._streamed(completion)
+                elif self.azure_async:
+                    # runs on the event loop of the shared HTTP client
+                    response = self.clients.http.submit(self.clients.azure_async(self.model).complete(
+                        messages=data["messages"],
+                        model=data["model"],
+                        max_tokens=data["max_tokens"],
+                        temperature=data["temperature"],
+                        model_extras={"n": n} if n > 1 else None,
+                    )).result()
+                else:
+                    response = self.clients.azure(self.model).complete(
+                        messages=data["messages"],
+                        model = data["model"],
+                        max_tokens=data["max_tokens"],
+                        temperature=data["temperature"],
+                        model_extras={"n": n} if n > 1 else None,
+                    )
+                self._record_request(start)
+                if response:
+                    self._record_usage(response)
                 if (response and "choices" in response and len(response["choices"]) > 0
-                        and response['choices'][0]['finish_reason'] == 'stop'):
+                        and all(choice['finish_reason'] == 'stop' for choice in response['choices'])):
+                    self.scheduler.on_success(self.provider)
                     logging.info(f'Received valid response: {response}')
                     return dict(response)
                 else:
+                    cause = "truncated" if response and response.get("choices") else "invalid_response"
                     logging.error(f"Error in response: {response}.")
+            except HttpResponseError as e:
+                self._record_request(start, error=True)
+                if e.status_code == 429:
+                    cause = "rate_limit"
+                    retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+                    if self.scheduler.on_rate_limit(self.provider, retry_after) is not None:
+                        delay = 0
+                else:
+                    cause = "server_error" if (e.status_code or 0) >= 500 else "client_error"
+                    logging.error(f"Error in request: {e}.")
             except Exception as e:
+                self._record_request(start, error=True)
+                cause = "connection_error"
                 logging.error(f"Error in request: {e}.")
 
-            logging.info(f"Retrying in {wait_time} seconds... (Attempt {attempt}/{self.max_retries})")
-            time.sleep(wait_time)
+            if attempt == self.max_retries or not self._retry(attempt, cause, delay):
+                break
 
         logging.critical(f"Max retries exceeded. No valid response after {self.max_retries} attempts.")
         return {}
 
 
-    def send_prompt(self, nb1: str, nb2: str, err_count: int = 0) -> dict:
-        load_dotenv()
-        match self.provider:
-            case "Azure":
-                if self.model == "Llama-3.3-70B-Instruct":
-                    self.API_KEY = os.getenv("AZURE_API_KEY")
-                    self.API_ENDPOINT = os.getenv("AZURE_API_ENDPOINT")
-                else:
-                    self.API_KEY = os.getenv("AZUREAI_ENDPOINT_KEY")
-                    self.API_ENDPOINT = os.getenv("AZURE_INFERENCE_SDK_ENDPOINT")
-                    return self._send_prompt_azure(nb1, nb2, err_count)
-            case "KISSKI":
-                self.API_KEY = os.getenv("KISSKI_API_KEY")
-                self.API_ENDPOINT = os.getenv("KISSKI_API_ENDPOINT")
-            case "LFI":
-                self.API_KEY = os.getenv("LFI_API_KEY")
-                self.API_ENDPOINT = os.getenv("LFI_API_ENDPOINT")
-            case _:
-                logging.warning(f"Provider '{self.provider}' not supported. Fallback to API_ENDPOINT.")
+    async def _stream_azure_async(self, completion: StreamedCompletion, request: dict):
+        """Reads the streamed Azure completion on the event loop of the shared HTTP client until the verdict is known."""
+        updates = await self.clients.azure_async(self.model).complete(stream=True, **request)
+        try:
+            async for update in updates:
+                if completion.feed_chunk(update.as_dict()):
+                    break
+        finally:
+            await updates.aclose()
+
+
+    def cache_key(self, nb1: str, nb2: str, err_count: int = 0, vote: int = 0, n: int = 1, repeat: int = 0) -> str:
+        """Key of the response for the pair (nb1, nb2) in the comparison cache."""
+        key_parts = dict(
+            system_prompt=self.system_prompt,
+            user_prompt=self.user_prompt_template.format(nb1=nb1, nb2=nb2),
+            model=self.model,
+            provider=self.provider,
+            temperature=(self.initial_temperature + self.temperature_increase_on_error * err_count),
+            max_output_tokens=self.max_output_tokens,
+            vote=vote,
+        )
+        if n > 1:
+            key_parts["n"] = n  # only for n > 1, so that existing cache entries stay valid
+        if repeat > 0:
+            key_parts["repeat"] = repeat
+        return ComparisonCache.make_key(**key_parts)
+
+    def send_prompt(self, nb1: str, nb2: str, err_count: int = 0, vote: int = 0, n: int = 1, repeat: int = 0) -> dict:
+        """Sends the prompt for the pair (nb1, nb2) to the provider, or answers it from the comparison cache.
+        The vote index distinguishes otherwise identical requests in majority voting, the repeat index repeated
+        comparisons of the same pair, see repeat_index. With n > 1, n completions are requested at once."""
+        key: str | None = None
+        if self.cache is not None:
+            key = self.cache_key(nb1, nb2, err_count, vote, n, repeat)
+            response = self.cache.get(key)
+            if response:
+                logging.info(f'Received cached response: {response}')
+                self._trace()["cached"] = True
+                self.metrics.increment("cache_hits")
+                return response
+
+        response = self._dispatch_prompt(nb1, nb2, err_count, n)
+        usage = (response or {}).get("usage") or {}
+        trace = self._trace()
+        trace["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        trace["completion_tokens"] += usage.get("completion_tokens") or 0
+        trace["cached_tokens"] += self.cached_tokens(usage) or 0
+        if response and self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+
+    def _dispatch_prompt(self, nb1: str, nb2: str, err_count: int = 0, n: int = 1) -> dict:
+        if self.provider == "Azure" and self.model != "Llama-3.3-70B-Instruct":
+            return self._send_prompt_azure(nb1, nb2, err_count, n)
 
         if not self.API_KEY or not self.API_ENDPOINT:
             raise Exception(f"API_KEY or API_ENDPOINT are not set for {self.provider=}. Check .env.")
-        return self._send_prompt_openai(nb1, nb2, err_count)
-
+        return self._send_prompt_openai(nb1, nb2, err_count, n)
+
+
+    def prefix_notebook(self, d1, d2):
+        """The notebook that comes first in the prompt, i.e. whose tokens are part of the cacheable prefix."""
+        template = self.user_prompt_template
+        if "{nb2}" in template and template.index("{nb2}") < template.index("{nb1}"):
+            return d2
+        return d1
+
+    def prefix_oriented(self, cmp):
+        """Wraps cmp so that the notebook of a pair that was compared more recently comes first in the prompt. If
+        that is the other notebook, the pair is compared in the opposite order and the result negated.
+        Consecutive comparisons with the same notebook, like the sift-down element in heapsort or the pivot in
+        quicksort, then share the prefix of system prompt and notebook, which providers with prefix caching
+        (vLLM, Ollama, Azure OpenAI) do not have to compute again."""
+        def oriented(d1, d2) -> bool:
+            with self._prefix_lock:
+                prefix, other = self.prefix_notebook(d1, d2), self.prefix_notebook(d2, d1)
+                swap = self._prefix_recency.get(other, -1) > self._prefix_recency.get(prefix, -1)
+                if swap:
+                    prefix, other = other, prefix
+                self._prefix_recency[other] = next(self._prefix_clock)
+                self._prefix_recency[prefix] = next(self._prefix_clock)
+            if swap:
+                logging.debug(f"Comparing {d2} and {d1} instead of {d1} and {d2} to reuse the prompt prefix.")
+                return not cmp(d2, d1)
+            return cmp(d1, d2)
+
+        oriented.__name__ = getattr(cmp, '__name__', type(cmp).__name__)
+        return oriented
+
+    def vote_indices(self) -> list[int]:
+        """Vote indices of all requests of one comparison, as used by llm_compare and llm_majority_vote."""
+        return list(range(1, self.votes + 1)) if self.majority_vote else [0]
 
     def parse_response(self, msg: str) -> bool:
         """Interprets the most common output forms that might deviate from instruction, i.e. ending like
@@ -195,43 +499,185 @@ class PRPmodel:
             raise ValueError("Output does not end with a valid Notebook identifier")
 
 
-    def llm_compare(self, d1, d2, err_count: int = 0) -> bool:
-        if err_count == self.max_retries:
-            logging.error(f"Compairing {d1} and {d2} failed after max number of retries.")
-            return False
-        response = self.send_prompt(str(self.dataset[d1]), str(self.dataset[d2]), err_count)
-        if response and "choices" in response and len(response["choices"]) > 0:
-            msg = response["choices"][0]["message"]["content"].strip()
-            try:
-                comparison: bool = self.parse_response(msg)
-                logging.info(f"{d1} < {d2}") if comparison else logging.info(f"{d1} > {d2}")
-                return comparison
-            except ValueError:
-                if err_count < self.max_retries:
+    def emit_comparison(self, d1, d2, vote: int, err_count: int, start: float, result: bool | None,
+                        answer: str | None = None, **fields):
+        """Writes the structured 'comparison' event with the requests traced since start."""
+        self.metrics.observe("comparison_seconds", time.perf_counter() - start)
+        self.metrics.increment("comparisons" if result is not None else "failed_comparisons")
+        self.events.emit(
+            "comparison", d1=d1, d2=d2, vote=vote, result=result, answer=answer[-100:] if answer else answer,
+            err_count=err_count, temperature=self.initial_temperature + self.temperature_increase_on_error * err_count,
+            latency=time.perf_counter() - start, model=self.model, provider=self.provider, **self._trace(), **fields)
+
+    def _local_scores(self, orders: list[tuple]) -> list[float]:
+        """Probability of 'Notebook B' for each ordered pair, from the comparison cache or the local model."""
+        texts, keys, scores = {}, {}, {}
+        for d1, d2 in orders:
+            nb1, nb2 = self.build_pair(d1, d2)
+            user_msg = self.user_prompt_template.format(nb1=nb1, nb2=nb2)
+            keys[(d1, d2)] = ComparisonCache.make_key(system_prompt=self.system_prompt, user_prompt=user_msg,
+                                                       model=self.model, provider=self.provider, scoring="logits",
+                                                       answer_prefix=self.local.answer_prefix)
+            response = self.cache.get(keys[(d1, d2)]) if self.cache is not None else None
+            if response:
+                self._trace()["cached"] = True
+                self.metrics.increment("cache_hits")
+                scores[(d1, d2)] = response["probability"]
+            else:
+                texts[(d1, d2)] = self.local.render(self.system_prompt, user_msg)
+
+        if texts:
+            start = time.perf_counter()
+            results = self.local.score(list(texts.values()))
+            self.metrics.observe("request_seconds", time.perf_counter() - start)
+            self.metrics.increment("requests", len(texts))
+            for order, (probability, mass) in zip(texts, results):
+                self._trace()["attempts"] += 1
+                self.metrics.observe("label_probability_mass", mass)
+                if mass < 0.5:
+                    logging.warning(f"The local model puts only {mass:.1%} of the probability on the labels for {order}.")
+                scores[order] = probability
+                if self.cache is not None:
+                    self.cache.put(keys[order], {"probability": probability, "label_mass": mass})
+        return [scores[order] for order in orders]
+
+    def local_probabilities(self, pairs: list[tuple], both_orientations: bool | None = None) -> list[float]:
+        """Probability of d1 < d2 for each pair (d1, d2). With both orientations, (d1, d2) and (d2, d1) are scored
+        in the same batch and averaged, which cancels the position bias of the model."""
+        both = self.both_orientations if both_orientations is None else both_orientations
+        if not both:
+            return self._local_scores(pairs)
+        scores = self._local_scores([order for d1, d2 in pairs for order in ((d1, d2), (d2, d1))])
+        return [(scores[2 * i] + 1 - scores[2 * i + 1]) / 2 for i in range(len(pairs))]
+
+    def local_compare_batch(self, pairs: list[tuple], both_orientations: bool | None = None, vote: int = 0) -> list[bool]:
+        """cmp(d1, d2) for all pairs, scored by the local model in as few forward passes as possible."""
+        start = time.perf_counter()
+        self._reset_trace()
+        results = []
+        for (d1, d2), probability in zip(pairs, self.local_probabilities(pairs, both_orientations)):
+            comparison = probability > 0.5
+            logging.info(f"{d1} < {d2} with p={probability:.3f}") if comparison else logging.info(f"{d1} > {d2} with p={1 - probability:.3f}")
+            self.metrics.observe("confidence", abs(2 * probability - 1))
+            self.emit_comparison(d1, d2, vote, 0, start, comparison, probability=probability)
+            results.append(comparison)
+        return results
+
+    def local_compare(self, d1, d2, vote: int = 0) -> bool:
+        return self.local_compare_batch([(d1, d2)], vote=vote)[0]
+
+    def repeat_index(self, d1, d2, vote: int = 0) -> int:
+        """How often the pair was compared in this order before in this experiment. Algorithms like active_ranking
+        compare pairs repeatedly to average out contradicting answers, so every repetition is a new request and
+        not the cached answer of the first one. The n-th repetition is still cached for later experiments."""
+        with self._repeats_lock:
+            repeat = self._repeats.get((d1, d2, vote), 0)
+            self._repeats[(d1, d2, vote)] = repeat + 1
+        return repeat
+
+    def llm_compare(self, d1, d2, err_count: int = 0, vote: int = 0) -> bool:
+        if self.local is not None:
+            return self.local_compare(d1, d2, vote)
+        start = time.perf_counter()
+        self._reset_trace()
+        repeat = self.repeat_index(d1, d2, vote)
+        for err_count in range(err_count, self.max_retries):
+            response = self.send_prompt(*self.build_pair(d1, d2), err_count, vote, repeat=repeat)
+            if response and "choices" in response and len(response["choices"]) > 0:
+                msg = response["choices"][0]["message"]["content"].strip()
+                try:
+                    comparison: bool = self.parse_response(msg)
+                    logging.info(f"{d1} < {d2}") if comparison else logging.info(f"{d1} > {d2}")
+                    self.emit_comparison(d1, d2, vote, err_count, start, comparison, msg, repeat=repeat)
+                    return comparison
+                except ValueError:
+                    # retry right away, the next attempt uses a higher temperature
+                    self.metrics.increment("parse_failures")
                     logging.warning(f"Response was not decisively. {msg=}. Retrying... {err_count}/{self.max_retries}")
-                    return self.llm_compare(d1, d2, err_count=err_count + 1)
-                else:
-                    logging.error(f"Compairing {d1} and {d2} failed after max number of retries. Assuming {d1} > {d2}.")
-                    return False
-        else:
+                    continue
             logging.error(f"Compairing {d1} and {d2} failed. Unexpected response: {response}")
-
-        wait_time = 2 ** (err_count + 1)
-        logging.warning(f"Retrying in {wait_time} seconds... (Attempt {err_count}/{self.max_retries})")
-        time.sleep(wait_time)
-        return self.llm_compare(d1, d2, err_count=err_count + 1)
+            if not self._retry(err_count + 1, "empty_response"):
+                break
+
+        self.emit_comparison(d1, d2, vote, err_count, start, None, repeat=repeat)
+        raise ComparisonError(f"Compairing {d1} and {d2} failed after max number of retries.")
+
+    def llm_compare_n(self, d1, d2, n: int, vote: int = 0) -> list[bool]:
+        """Like llm_compare, but samples n answers with a single request using the n parameter of the API.
+        If some answers cannot be parsed, only the missing ones are requested again."""
+        start = time.perf_counter()
+        self._reset_trace()
+        results: list[bool] = []
+        repeat = self.repeat_index(d1, d2, vote)
+        for err_count in range(self.max_retries):
+            response = self.send_prompt(*self.build_pair(d1, d2), err_count, vote, n=n - len(results), repeat=repeat)
+            for choice in (response or {}).get("choices", []):
+                msg = choice["message"]["content"].strip()
+                try:
+                    comparison: bool = self.parse_response(msg)
+                    logging.info(f"{d1} < {d2}") if comparison else logging.info(f"{d1} > {d2}")
+                    results.append(comparison)
+                    self.emit_comparison(d1, d2, vote, err_count, start, comparison, msg, n=n, repeat=repeat)
+                except ValueError:
+                    self.metrics.increment("parse_failures")
+                    logging.warning(f"Response was not decisively. {msg=}. Retrying... {err_count}/{self.max_retries}")
+            if len(results) >= n:
+                return results[:n]
+            if not response:
+                logging.error(f"Compairing {d1} and {d2} failed. Unexpected response: {response}")
+                if not self._retry(err_count + 1, "empty_response"):
+                    break
+
+        raise ComparisonError(f"Compairing {d1} and {d2} failed after max number of retries, "
+                              f"{n - len(results)} of {n} votes are missing.")
+
+    def _cast_votes(self, d1, d2, first_vote: int, count: int) -> list[bool]:
+        """Casts count votes at once, either as one request with count completions or as concurrent requests."""
+        if self.n_completions:
+            return self.llm_compare_n(d1, d2, count, vote=first_vote)
+        if count == 1:
+            return [self.llm_compare(d1, d2, vote=first_vote)]
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self.llm_compare, d1, d2, vote=vote)
+                       for vote in range(first_vote, first_vote + count)]
+            return [future.result() for future in futures]
+
+    def _parallel_majority_vote(self, d1, d2) -> bool:
+        """Casts as many votes at once as are still needed for a majority, so unanimous pairs take a single round
+        and further votes are only requested while the answers disagree."""
+        majority = self.votes // 2 + 1
+        smaller, larger = 0, 0  # votes for d1 < d2 and for d1 > d2
+        while max(smaller, larger) < majority and smaller + larger < self.votes:
+            count = min(majority - max(smaller, larger), self.votes - smaller - larger)
+            results = self._cast_votes(d1, d2, smaller + larger + 1, count)
+            smaller += sum(results)
+            larger += len(results) - sum(results)
+            logging.debug(f"Majority voting for {d1} vs. {d2} now at {smaller}:{larger}.")
+
+        self.events.emit("majority_vote", d1=d1, d2=d2, smaller=smaller, larger=larger, votes=self.votes)
+        if smaller > larger:
+            logging.info(f'{d1} < {d2} with {smaller}/{self.votes} votes.')
+            return True
+        else:
+            logging.info(f'{d1} > {d2} with {larger}/{self.votes} votes.')
+            return False
 
     def llm_majority_vote(self, d1, d2):
+        if self.parallel_votes or self.n_completions:
+            return self._parallel_majority_vote(d1, d2)
+
         votes = 0
         majority = self.votes // 2 + 1
         for i in range(1, self.votes + 1):
-            if self.llm_compare(d1, d2):
+            if self.llm_compare(d1, d2, vote=i):
                 votes += 1
             else:
                 votes -= 1
 
             # Early stopping if absolut majority is reached
             logging.debug(f"Majority voting for {d1} vs. {d2} now at {votes}.")
+            if votes >= majority or votes <= -majority:
+                self.events.emit("majority_vote", d1=d1, d2=d2, smaller=(i + votes) // 2, larger=(i - votes) // 2, votes=self.votes)
             if votes >= majority:
                 logging.info(f'{d1} < {d2} with {(i+votes)/2}/{self.votes} votes.')
                 return True
@@ -239,6 +685,7 @@ class PRPmodel:
                 logging.info(f'{d1} > {d2} with {(i-votes)/2}/{self.votes} votes.')
                 return False
 
+        self.events.emit("majority_vote", d1=d1, d2=d2, smaller=(self.votes + votes) // 2, larger=(self.votes - votes) // 2, votes=self.votes)
         if votes > 0:
             logging.info(f'{d1} < {d2} with {(self.votes + votes) / 2}/{self.votes} votes.')
             return True
@@ -0,0 +1,143 @@
+"""Local inference backend that decides comparisons from the next-token logits of a small causal language model.
+
+The chat prompt of a comparison is followed by the beginning of the answer (e.g. "Notebook"), so that a single
+forward pass gives the logits of the next token. The probabilities of " A" and " B", normalized over these two
+tokens, replace the generated answer and parse_response: no tokens are generated and every prompt yields a
+decision together with its confidence.
+"""
+import inspect
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from configparser import ConfigParser
+
+from logs import global_logger as logging
+import tokens
+
+
+class LocalScorer:
+    """
+    Scores comparison prompts with a Hugging Face model, shared by all experiments of this process.
+
+    Prompts of concurrent comparisons are collected by a worker thread, which scores all waiting prompts (up to
+    batch_size) in one left-padded forward pass. So the two orientations of a pair and the pairs of a parallel
+    sorting round share a forward pass.
+
+    :param repo: Hugging Face repository of the model.
+    :param device: Device of the model, e.g. cuda or cpu. Defaults to cuda if available.
+    :param dtype: Torch dtype of the weights, e.g. bfloat16, or auto.
+    :param batch_size: Maximum number of prompts per forward pass.
+    :param answer_prefix: Beginning of the answer, after which the label tokens are scored.
+    """
+    _shared: dict[tuple, "LocalScorer"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, repo: str, device: str | None = None, dtype: str = "auto", batch_size: int = 8,
+                 answer_prefix: str = "Notebook", labels: tuple[str, str] = ("A", "B")):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.repo = repo
+        self.batch_size = batch_size
+        self.answer_prefix = answer_prefix
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(repo, token=os.getenv("HUGGINGFACE"))
+        # left padding, so that the last position of every row is the last token of its prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(
+            repo, token=os.getenv("HUGGINGFACE"),
+            torch_dtype=dtype if dtype == "auto" else getattr(torch, dtype)).to(self.device)
+        self.model.eval()
+        # only the logits of the last position are needed, not the full vocabulary for every position
+        self._forward_kwargs = {"num_logits_to_keep": 1} \
+            if "num_logits_to_keep" in inspect.signature(self.model.forward).parameters else {}
+        self.label_ids: list[int] = [self._label_token(label) for label in labels]
+        logging.info(f"Loaded local model '{repo}' on {self.device}, scoring the tokens "
+                     f"{self.tokenizer.convert_ids_to_tokens(self.label_ids)} after '{answer_prefix}'.")
+
+        self.forward_passes: int = 0
+        self.prompts: int = 0
+        self._queue: queue.Queue = queue.Queue()
+        threading.Thread(target=self._worker, name=f"LocalScorer({repo})", daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "LocalScorer":
+        """Returns the scorer of the [Local] section, shared by all experiments of this process that use the same
+        model and settings, so that the weights are loaded only once."""
+        model = config['Model']['model']
+        repo = config.get('Local', 'repo', fallback=tokens.MODEL_TOKENIZERS.get(model))
+        assert repo is not None, f"No Hugging Face repository known for model '{model}', set [Local] repo."
+        key = (repo, config.get('Local', 'device', fallback=None), config.get('Local', 'dtype', fallback='auto'),
+               config.getint('Local', 'batch_size', fallback=8), config.get('Local', 'answer_prefix', fallback='Notebook'))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(*key)
+            return cls._shared[key]
+
+    def _label_token(self, label: str) -> int:
+        """Token that follows the answer prefix for the label, e.g. ' A' after 'Notebook'."""
+        prefix = self.tokenizer.encode(self.answer_prefix, add_special_tokens=False)
+        answer = self.tokenizer.encode(f"{self.answer_prefix} {label}", add_special_tokens=False)
+        if answer[:len(prefix)] == prefix and len(answer) > len(prefix):
+            return answer[len(prefix)]
+        return answer[-1]
+
+    def render(self, system_prompt: str, user_msg: str) -> str:
+        """Chat prompt of the model, followed by the answer prefix."""
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_msg}]
+        try:
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        except Exception:
+            # some chat templates (e.g. Gemma) do not support a system message
+            messages = [{"role": "user", "content": f"{system_prompt}\n\n{user_msg}"}]
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return text + self.answer_prefix
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def score(self, texts: list[str]) -> list[tuple[float, float]]:
+        """Probability of the second label ("B") and the probability mass of both labels for each prompt.
+        Blocks until all prompts were scored, together with the prompts of other threads."""
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for (_, future), result in zip(batch, self._forward([text for text, _ in batch])):
+                    future.set_result(result)
+            except Exception as e:
+                logging.error(f"Forward pass of {len(batch)} prompts failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def _forward(self, texts: list[str]) -> list[tuple[float, float]]:
+        import torch
+
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.device)
+        with torch.inference_mode():
+            logits = self.model(**inputs, **self._forward_kwargs).logits[:, -1, :].float()
+        self.forward_passes += 1
+        self.prompts += len(texts)
+        probabilities = torch.softmax(logits, dim=-1)[:, self.label_ids]
+        mass = probabilities.sum(dim=-1)
+        p_second = probabilities[:, 1] / mass
+        return list(zip(p_second.tolist(), mass.tolist()))
+
+    def stats(self) -> str:
+        per_pass = self.prompts / self.forward_passes if self.forward_passes else 0
+        return f"Local model {self.repo}: {self.prompts} prompts in {self.forward_passes} forward passes ({per_pass:.1f} per pass)."
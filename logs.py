@@ -1,4 +1,12 @@
+import contextvars
+import glob
+import json
 import logging
+import os
+import threading
+import time
+
+import pandas as pd
 class TerminalFormatter(logging.Formatter):
     grey = "\x1b[38;20m"
     yellow = "\x1b[33;20m"
@@ -46,3 +54,88 @@ def add_file_handler(logger, log_file):
     logger.addHandler(file_handler)
 
 global_logger: logging.Logger = setup_logger('llmsort', logging.DEBUG)
+
+# name of the experiment the current thread works for, when several experiments run at the same time
+current_experiment: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_experiment", default=None)
+
+
+class ExperimentFilter(logging.Filter):
+    """Passes only records logged in the context of the given experiment."""
+    def __init__(self, experiment: str):
+        super().__init__()
+        self.experiment = experiment
+
+    def filter(self, record):
+        return current_experiment.get() == self.experiment
+
+
+def add_experiment_file_handler(logger, log_file, experiment) -> logging.FileHandler:
+    """Like add_file_handler, but keeps the file handlers of other experiments running at the same time.
+    Threads working for the experiment must run in a context with current_experiment set, see
+    contextvars.copy_context(). The returned handler has to be removed when the experiment is finished."""
+    file_handler = logging.FileHandler(f"./experiments/logs/{log_file}")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    file_handler.addFilter(ExperimentFilter(experiment))
+    logger.addHandler(file_handler)
+    return file_handler
+
+
+class EventSink:
+    """Structured, machine-readable counterpart of the text log: every event is written as one JSON line with the
+    run id, the event type, a timestamp and its fields, e.g. one 'comparison' record per comparison.
+    Without an open file, events are dropped."""
+    def __init__(self):
+        self.run: str | None = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self, path: str, run: str):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+            self.run = run
+
+    def emit(self, event: str, **fields):
+        with self._lock:
+            if self._file is None:
+                return
+            record = {"run": self.run, "event": event, "time": time.time(), **fields}
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            self.run = None
+
+
+def add_event_file(sink: EventSink, event_file: str, run: str):
+    """Like add_file_handler, but for the structured events of a run, appended to ./experiments/events/."""
+    sink.open(f"./experiments/events/{event_file}", run)
+
+
+def load_events(paths: str | list[str] = "./experiments/events/*.jsonl", event: str | None = None) -> pd.DataFrame:
+    """Reads the events of many runs into a single DataFrame, optionally only events of one type.
+    paths may be a glob pattern or a list of files; the file name without extension is added as 'experiment'."""
+    files = sorted(glob.glob(paths)) if isinstance(paths, str) else paths
+    records = []
+    for file in files:
+        experiment = os.path.splitext(os.path.basename(file))[0]
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                if event is not None and f'"event": "{event}"' not in line:
+                    continue  # skip parsing lines of other events
+                records.append({"experiment": experiment, **json.loads(line)})
+    df = pd.DataFrame.from_records(records)
+    if not df.empty:
+        if event is not None:
+            df = df[df["event"] == event].dropna(axis=1, how="all").reset_index(drop=True)
+        df["time"] = pd.to_datetime(df["time"], unit="s")
+    return df
+
+
+global_events: EventSink = EventSink()
@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+
+class Metrics:
+    """
+    Thread-safe counters and histograms of an experiment, e.g. request latencies, token usage and retries per cause.
+
+    Histograms keep all observed values (an experiment has at most a few thousand requests), so that exact
+    percentiles can be reported at the end.
+    """
+    def __init__(self):
+        self.counters: dict[str, float] = defaultdict(int)
+        self.values: dict[str, list[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.values[name].append(value)
+
+    def histogram(self, name: str, bins: int = 10) -> dict:
+        """Counts of the values of name in bins, logarithmically spaced for positive values."""
+        values = np.array(self.values[name], dtype=float)
+        if values.size == 0:
+            return {"edges": [], "counts": []}
+        if values.min() > 0 and values.max() > values.min():
+            edges = np.geomspace(values.min(), values.max(), bins + 1)
+        else:
+            edges = np.linspace(values.min(), values.max() if values.max() > values.min() else values.min() + 1, bins + 1)
+        counts, edges = np.histogram(values, bins=edges)
+        return {"edges": edges.round(6).tolist(), "counts": counts.tolist()}
+
+    def summary(self) -> pd.DataFrame:
+        """One row per histogram with count, sum, mean and percentiles."""
+        with self._lock:
+            values = {name: np.array(v, dtype=float) for name, v in self.values.items() if v}
+        rows = {
+            name: {
+                "count": v.size, "sum": v.sum(), "mean": v.mean(), "min": v.min(),
+                "p50": np.percentile(v, 50), "p90": np.percentile(v, 90), "p99": np.percentile(v, 99), "max": v.max(),
+            }
+            for name, v in sorted(values.items())
+        }
+        return pd.DataFrame.from_dict(rows, orient="index")
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {name: {**row, "histogram": self.histogram(name)}
+                           for name, row in self.summary().to_dict(orient="index").items()},
+        }
+
+    def export(self, path: str, **fields):
+        """Writes the counters and histograms as JSON, together with fields describing the run."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**fields, **self.to_dict()}, f, indent=2, default=float)
+
+    def report(self) -> str:
+        counters = "\n".join(f"  {name}: {value:g}" for name, value in sorted(self.counters.items()))
+        with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+            return f"Metrics:\n{self.summary()}\nCounters:\n{counters}"
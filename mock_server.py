@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Local stand-in for an OpenAI-compatible chat completion API, to load-test the request path of PRPmodel offline.
+
+Start only the server:
+
+    python mock_server.py --port 8765 --latency-median 0.5 --rate-limit-rate 0.05
+
+or run experiments against it; all provider endpoints are redirected to the mock server:
+
+    python mock_server.py --loadtest experiments/017.1_quicksort.ini \\
+        --override Data.data_path=./data/test-data/ Data.exercises=photosynthese/ Data.expert_ranking=photosynthese.csv
+"""
+import argparse
+import configparser
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockBehaviour:
+    """
+    Configurable behaviour of the mock server.
+
+    - latency_median, latency_sigma: response latency is log-normally distributed with this median (seconds)
+      and sigma of the underlying normal distribution.
+    - rate_limit_rate: probability of answering 429 with a Retry-After of retry_after seconds.
+    - truncated_rate: probability of a response with finish_reason 'length'.
+    - malformed_rate: probability of an answer that parse_response cannot interpret.
+    - answer_b_rate: probability of answering 'Notebook B'.
+    - reasoning_words: length of a <think> trace before the answer, like DeepSeek-R1.
+    - explanation_rate: probability of an explanation after the verdict, which parse_response does not accept.
+    - token_delay: generation time per word in seconds, streamed responses send one word per chunk.
+    """
+    def __init__(self, latency_median: float = 0.2, latency_sigma: float = 0.5, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0, truncated_rate: float = 0.0, malformed_rate: float = 0.0,
+                 answer_b_rate: float = 0.5, seed: int | None = None, reasoning_words: int = 0,
+                 explanation_rate: float = 0.0, token_delay: float = 0.0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.truncated_rate = truncated_rate
+        self.malformed_rate = malformed_rate
+        self.answer_b_rate = answer_b_rate
+        self.reasoning_words = reasoning_words
+        self.explanation_rate = explanation_rate
+        self.token_delay = token_delay
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats: dict[str, float] = {"requests": 0, "rate_limited": 0, "truncated": 0, "malformed": 0,
+                                        "latency_seconds": 0.0, "streams": 0, "streams_cancelled": 0,
+                                        "words_generated": 0}
+
+    def draw(self) -> tuple[float, float, float, float, float]:
+        with self._lock:
+            latency = self.latency_median * math.exp(self.random.gauss(0, self.latency_sigma)) \
+                if self.latency_median > 0 else 0.0
+            return latency, self.random.random(), self.random.random(), self.random.random(), self.random.random()
+
+    def count(self, key: str, value: float = 1):
+        with self._lock:
+            self.stats[key] += value
+
+
+def words(content: str) -> list[str]:
+    """Chunks of a streamed content, one word with its following whitespace each."""
+    return re.findall(r'\S+\s*|\s+', content)
+
+
+def completion(model: str, contents: list[str], finish_reason: str, prompt: str, cached_tokens: int = 0) -> dict:
+    prompt_tokens = len(prompt) // 4 + 1
+    completion_tokens = sum(len(c) // 4 + 1 for c in contents)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+            for i, content in enumerate(contents)
+        ],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers chat completions and, for batch.py, the files and batches endpoints. Batches complete at once."""
+    behaviour: MockBehaviour = MockBehaviour()
+    protocol_version = "HTTP/1.1"  # keep-alive
+    files: dict[str, str] = {}
+    batches: dict[str, dict] = {}
+    last_prompt: str = ""  # simulates a prefix cache holding the previous prompt
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict | None = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if "/batches/" in path and path.rsplit("/", 1)[1] in self.batches:
+            self._send_json(200, self.batches[path.rsplit("/", 1)[1]])
+        elif path.endswith("/content") and path.split("/")[-2] in self.files:
+            payload = self.files[path.split("/")[-2]].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        if path.endswith("/files"):
+            self._upload_file(raw)
+            return
+        body = json.loads(raw or b"{}")
+        if path.endswith("/batches"):
+            self._create_batch(body)
+            return
+        if not path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        status, response, headers = self._complete(body, stream=body.get("stream", False))
+        if status == 200 and body.get("stream"):
+            self._send_stream(response, (body.get("stream_options") or {}).get("include_usage", False))
+        else:
+            self._send_json(status, response, headers)
+
+    def _send_chunk(self, data: str):
+        payload = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _send_stream(self, response: dict, include_usage: bool):
+        """Sends the completion as server-sent events, one word per chunk and token_delay apart. Stops when the
+        client closes the connection, like a provider that stops generating."""
+        behaviour = self.behaviour
+        behaviour.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = {"id": response["id"], "object": "chat.completion.chunk", "created": response["created"],
+                 "model": response["model"]}
+        choices = [words(choice["message"]["content"]) for choice in response["choices"]]
+        try:
+            for step in range(max(map(len, choices), default=0)):
+                deltas = [{"index": i, "delta": {"content": c[step]}, "finish_reason": None}
+                          for i, c in enumerate(choices) if step < len(c)]
+                self._send_chunk(json.dumps({**chunk, "choices": deltas}))
+                behaviour.count("words_generated", len(deltas))
+                time.sleep(behaviour.token_delay)
+            self._send_chunk(json.dumps({**chunk, "choices": [
+                {"index": choice["index"], "delta": {}, "finish_reason": choice["finish_reason"]}
+                for choice in response["choices"]]}))
+            if include_usage:
+                self._send_chunk(json.dumps({**chunk, "choices": [], "usage": response["usage"]}))
+            self._send_chunk("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            behaviour.count("streams_cancelled")
+            self.close_connection = True
+
+    def _upload_file(self, raw: bytes):
+        # the JSONL file is the part of the multipart body that starts with a JSON object
+        content = "\n".join(line for line in raw.decode("utf-8", errors="replace").splitlines()
+                            if line.startswith("{"))
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = content
+        self._send_json(200, {"id": file_id, "object": "file", "purpose": "batch"})
+
+    def _create_batch(self, body: dict):
+        results = []
+        for line in self.files.get(body.get("input_file_id"), "").splitlines():
+            request = json.loads(line)
+            status, response, _ = self._complete(request["body"])
+            results.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                            "response": {"status_code": status, "body": response}, "error": None})
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        self.files[output_file_id] = "\n".join(json.dumps(result) for result in results)
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {"id": batch_id, "object": "batch", "status": "completed",
+                                  "input_file_id": body.get("input_file_id"), "output_file_id": output_file_id,
+                                  "request_counts": {"total": len(results), "completed": len(results), "failed": 0}}
+        self._send_json(200, self.batches[batch_id])
+
+    def _complete(self, body: dict, stream: bool = False) -> tuple[int, dict, dict | None]:
+        """Status, body and headers of the answer to a chat completion request. Unless it is streamed, the
+        generation time of the words is waited for here."""
+        behaviour = self.behaviour
+        behaviour.count("requests")
+        latency, r_rate_limit, r_truncated, r_malformed, r_answer = behaviour.draw()
+        time.sleep(latency)
+        behaviour.count("latency_seconds", latency)
+
+        if r_rate_limit < behaviour.rate_limit_rate:
+            behaviour.count("rate_limited")
+            return 429, {"error": {"message": "Rate limit exceeded"}}, {"Retry-After": str(behaviour.retry_after)}
+
+        prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []))
+        common_prefix = len(os.path.commonprefix([prompt, type(self).last_prompt]))
+        type(self).last_prompt = prompt
+        contents = []
+        for i in range(body.get("n", 1)):
+            r_answer = r_answer if i == 0 else behaviour.draw()[4]
+            if r_malformed < behaviour.malformed_rate:
+                behaviour.count("malformed")
+                contents.append("Both notebooks have their strengths.")
+            else:
+                contents.append("Notebook B" if r_answer < behaviour.answer_b_rate else "Notebook A")
+            if behaviour.random.random() < behaviour.explanation_rate:
+                contents[-1] += "\n\n" + " ".join(["The other notebook misses parts of the exercises."] * 5)
+            if behaviour.reasoning_words:
+                contents[-1] = f"<think>\n{' '.join(['Hmm,'] * behaviour.reasoning_words)}\n</think>\n\n{contents[-1]}"
+
+        finish_reason = "stop"
+        if r_truncated < behaviour.truncated_rate:
+            behaviour.count("truncated")
+            finish_reason = "length"
+            contents = [c[:len(c) // 2] for c in contents]
+        if not stream:
+            generated = max(len(words(c)) for c in contents)
+            behaviour.count("words_generated", sum(len(words(c)) for c in contents))
+            time.sleep(behaviour.token_delay * generated)
+        return 200, completion(body.get("model", "mock"), contents, finish_reason, prompt, common_prefix // 4), None
+
+
+def start_server(behaviour: MockBehaviour, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Starts the mock server in a background thread. With port 0 a free port is chosen."""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"behaviour": behaviour, "files": {}, "batches": {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+
+def mock_environment(base_url: str) -> dict[str, str]:
+    """Environment redirecting every provider of PRPmodel to the mock server."""
+    return {
+        **os.environ,
+        "KISSKI_API_KEY": "mock", "KISSKI_API_ENDPOINT": f"{base_url}/v1/chat/completions",
+        "LFI_API_KEY": "mock", "LFI_API_ENDPOINT": f"{base_url}/ollama/v1/chat/completions",
+        "AZURE_API_KEY": "mock", "AZURE_API_ENDPOINT": f"{base_url}/chat/completions",
+        "AZUREAI_ENDPOINT_KEY": "mock", "AZURE_INFERENCE_SDK_ENDPOINT": f"{base_url}/models",
+    }
+
+
+def loadtest(config_files: list[str], behaviour: MockBehaviour, overrides: list[str], jobs: int = 0) -> list[dict]:
+    """Runs execute.py for every config against a fresh mock server and returns wall time and server stats.
+    With jobs > 0, all configs are run by a single execute.py with that many experiments at the same time."""
+    server = start_server(behaviour)
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_configs = []
+        for config_file in config_files:
+            config = configparser.ConfigParser()
+            config.read(config_file)
+            # fresh comparison cache per load test, unless overridden
+            config.read_dict({"Cache": {"path": os.path.join(tmp_dir, "comparisons.sqlite")}})
+            for override in overrides:
+                key, value = override.split("=", 1)
+                section, option = key.split(".", 1)
+                if not config.has_section(section):
+                    config.add_section(section)
+                config.set(section, option, value)
+            # prefixed name, so that the logs of real experiments are not overwritten
+            name = "loadtest_" + os.path.basename(config_file)
+            tmp_config = os.path.join(tmp_dir, name)
+            with open(tmp_config, "w") as f:
+                config.write(f)
+            tmp_configs.append(tmp_config)
+
+        runs = [(" ".join(config_files), tmp_configs + ["--jobs", str(jobs)])] if jobs > 0 else \
+            [(config_file, [tmp_config]) for config_file, tmp_config in zip(config_files, tmp_configs)]
+        for name, arguments in runs:
+            before = dict(behaviour.stats)
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "execute.py", *arguments], env=mock_environment(base_url))
+            wall_time = time.perf_counter() - start
+            stats = {key: behaviour.stats[key] - before[key] for key in behaviour.stats}
+            results.append({"config": name, "returncode": process.returncode, "wall_time": wall_time,
+                            **stats, "requests_per_second": stats["requests"] / wall_time})
+    server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-median", type=float, default=0.2, help="median response latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the log-normal latency")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of 429 responses in seconds")
+    parser.add_argument("--truncated-rate", type=float, default=0.0, help="probability of finish_reason 'length'")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="probability of an unparsable answer")
+    parser.add_argument("--answer-b-rate", type=float, default=0.5, help="probability of answering 'Notebook B'")
+    parser.add_argument("--reasoning-words", type=int, default=0, help="length of a <think> trace before the answer")
+    parser.add_argument("--explanation-rate", type=float, default=0.0, help="probability of text after the verdict")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="generation time per word in seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--loadtest", nargs="+", metavar="CONFIG", help="experiment configs to run against the mock")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="run all load test configs in one execute.py with this many experiments at the same time")
+    parser.add_argument("--override", nargs="*", default=[], metavar="SECTION.KEY=VALUE",
+                        help="config values to override for the load test, e.g. Sorting.parallel=True")
+    args = parser.parse_args()
+
+    mock_behaviour = MockBehaviour(args.latency_median, args.latency_sigma, args.rate_limit_rate, args.retry_after,
+                                   args.truncated_rate, args.malformed_rate, args.answer_b_rate, args.seed,
+                                   args.reasoning_words, args.explanation_rate, args.token_delay)
+    if args.loadtest:
+        for result in loadtest(args.loadtest, mock_behaviour, args.override, args.jobs):
+            print(", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()))
+    else:
+        mock_server = start_server(mock_behaviour, args.host, args.port)
+        print(f"Mock server listening on http://{args.host}:{args.port}, press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            mock_server.shutdown()
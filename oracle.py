@@ -0,0 +1,82 @@
+import threading
+
+
+class ComparisonOracle:
+    """
+    Wraps a comparison function and answers comparisons that are already decided without calling it again.
+
+    The decided pairs form a directed graph with an edge x -> y for x < y. A comparison is answered
+    - from an earlier call with the same pair in the same order,
+    - with symmetric=True also from an earlier call in the opposite order, i.e. one call decides both orders,
+    - with transitive=True from the transitive closure of the graph, e.g. A < C follows from A < B and B < C.
+      The opposite order of a pair that was compared directly is not inferred unless symmetric=True, so that
+      symmetric=False keeps sampling both orders, e.g. to study the position bias.
+
+    Only pairs that are not yet decided reach the comparison function, so with transitive=True no cycles can be
+    introduced. The closure is kept up to date on every new edge, so lookups take constant time.
+
+    :param cmp: Comparison function (Lambda) that compares two elements.
+    """
+    def __init__(self, cmp=lambda x, y: x < y, transitive: bool = True, symmetric: bool = False):
+        self.cmp = cmp
+        self.transitive = transitive
+        self.symmetric = symmetric
+        self.__name__ = getattr(cmp, '__name__', type(cmp).__name__)
+        self.decided: dict[tuple, bool] = {}
+        self.greater: dict = {}  # x -> all elements known to be greater than x
+        self.calls = 0
+        self.repeated = 0
+        self.inferred = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, x, y) -> bool | None:
+        """Result of cmp(x, y) if it is already decided, otherwise None."""
+        if (x, y) in self.decided:
+            return self.decided[(x, y)]
+        if self.symmetric and (y, x) in self.decided:
+            return not self.decided[(y, x)]
+        return None
+
+    def infer(self, x, y) -> bool | None:
+        """Result of cmp(x, y) following from the transitive closure, otherwise None."""
+        if y in self.greater.get(x, ()):
+            return True
+        if x in self.greater.get(y, ()):
+            return False
+        return None
+
+    def _add_edge(self, smaller, larger):
+        if larger in self.greater.get(smaller, ()):
+            return
+        above = {larger} | self.greater.get(larger, set())
+        for element, greater in list(self.greater.items()):
+            if smaller in greater:
+                greater |= above
+        self.greater.setdefault(smaller, set()).update(above)
+
+    def __call__(self, x, y) -> bool:
+        with self._lock:
+            result = self.lookup(x, y)
+            if result is not None:
+                self.repeated += 1
+                return result
+            if self.transitive and (self.symmetric or (y, x) not in self.decided):
+                result = self.infer(x, y)
+                if result is not None:
+                    self.inferred += 1
+                    return result
+            self.calls += 1
+
+        result = self.cmp(x, y)
+
+        with self._lock:
+            self.decided[(x, y)] = result
+            if self.transitive and self.infer(x, y) is None:
+                self._add_edge(x, y) if result else self._add_edge(y, x)
+        return result
+
+    def summary(self) -> str:
+        avoided = self.repeated + self.inferred
+        total = self.calls + avoided
+        return (f"Comparison oracle avoided {avoided} of {total} comparisons "
+                f"({self.repeated} already decided, {self.inferred} by transitivity).")
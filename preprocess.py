@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+from configparser import ConfigParser
+from typing import Iterator
+
+import nbformat
+
+from filter import NOTEBOOK_FORMATS, remove_images, remove_outputs, render_notebook, truncate_outputs
+from logs import global_logger as logging
+
+# increase when the preprocessing changes, so that cached prompt texts of older versions are not reused
+PREPROCESSING_VERSION = 1
+
+
+def notebook_files(directory: str) -> Iterator[tuple[str, pathlib.Path]]:
+    """Yields (notebook id, path) for all notebooks in directory.
+    Notebook must be named '<exercise>_<hex_id>.ipynb' with <hex_id> matching the notebook id form the csv file."""
+    for file in pathlib.Path(directory).rglob('*.ipynb'):
+        notebook_hex = re.match(r'.*_([a-fA-F0-9]+)\.ipynb', file.name)
+        if not notebook_hex:
+            logging.warning(f"Notebook {file} does not match the naming convention and will be skipped.")
+            continue
+        yield notebook_hex.group(1), file
+
+
+def preprocessing_options(config: ConfigParser) -> dict:
+    """All settings of [Data Preprocessing] that change the prompt text of a notebook."""
+    return {
+        'filter_output_images': config.getboolean('Data Preprocessing', 'filter_output_images'),
+        'filter_output_cells': config.getboolean('Data Preprocessing', 'filter_output_cells'),
+        'notebook_format': config.get('Data Preprocessing', 'notebook_format', fallback='ipynb-json'),
+        'max_output_chars': config.getint('Data Preprocessing', 'max_output_chars', fallback=None),
+    }
+
+
+def preprocess_notebook(raw: str, options: dict) -> str:
+    """Turns the raw .ipynb content into the text that is inserted into the prompt."""
+    filters = []
+    if options['filter_output_images']:
+        filters.append(remove_images)
+    if options['filter_output_cells']:
+        filters.append(remove_outputs)
+    elif options.get('max_output_chars'):
+        filters.append(truncate_outputs(options['max_output_chars']))
+    if options['notebook_format'] not in NOTEBOOK_FORMATS:
+        logging.warning(f"Unknown notebook format '{options['notebook_format']}', using ipynb-json.")
+    # Reading Notebook as nbformat which is basically like json.read(f) but intended way; main difference
+    # ist that cell contents are not being read as an array of lines but as a string with newlines
+    return render_notebook(nbformat.reads(raw, as_version=4), filters, options['notebook_format'])
+
+
+class PreprocessingCache:
+    """Cache of preprocessed prompt texts, kept in memory and as text files on disk.
+
+    Entries are keyed by the hash of the raw notebook content and the preprocessing options, so changed
+    notebooks or options never hit stale entries.
+    """
+    _instances: dict[str, "PreprocessingCache"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hits: int = 0
+        self.misses: int = 0
+        self._memory: dict[str, str] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "PreprocessingCache | None":
+        """Returns the cache for the configured directory, shared by all experiments of this process."""
+        if not config.getboolean('Data Preprocessing', 'cache', fallback=True):
+            return None
+        directory = config.get('Data Preprocessing', 'cache_path', fallback='./experiments/cache/preprocessed/')
+        with cls._instances_lock:
+            if directory not in cls._instances:
+                cls._instances[directory] = cls(directory)
+            return cls._instances[directory]
+
+    @staticmethod
+    def make_key(raw: str, options: dict) -> str:
+        serialized = json.dumps({'version': PREPROCESSING_VERSION, 'options': options}, sort_keys=True)
+        return hashlib.sha256((serialized + raw).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key in self._memory:
+                self.hits += 1
+                return self._memory[key]
+        path = os.path.join(self.directory, f"{key}.txt")
+        if not os.path.isfile(path):
+            with self._lock:
+                self.misses += 1
+            return None
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        with self._lock:
+            self.hits += 1
+            self._memory[key] = text
+        return text
+
+    def put(self, key: str, text: str):
+        path = os.path.join(self.directory, f"{key}.txt")
+        # write to a temporary file first, so that concurrent readers never see partial files
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._memory[key] = text
+
+
+def load_prompt_texts(directory: str, options: dict, cache: PreprocessingCache | None = None) -> dict[str, str]:
+    """Loads all notebooks in directory and returns their preprocessed prompt texts by notebook id."""
+    data: dict[str, str] = {}
+    cached = 0
+    for notebook_hex, file in notebook_files(directory):
+        logging.debug(f"Loading notebook '{file.stem}' with id='{notebook_hex}'")
+        with open(file, encoding="utf-8") as f:
+            raw = f.read()
+        key = PreprocessingCache.make_key(raw, options) if cache is not None else None
+        text = cache.get(key) if cache is not None else None
+        if text is None:
+            text = preprocess_notebook(raw, options)
+            if cache is not None:
+                cache.put(key, text)
+        else:
+            cached += 1
+        data[notebook_hex] = text
+
+    logging.info(f"Loaded {len(data)} notebooks ({cached} from preprocessing cache) with {options}.")
+    return data
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+from configparser import ConfigParser
+
+from logs import global_logger as logging
+from sort import binary_insert
+
+# settings that change the outcome of comparisons; a ranking is only updated by experiments that agree on them
+RANKING_SETTINGS: dict[str, list[str]] = {
+    'Model': ['model', 'provider', 'max_output_tokens', 'initial_temperature', 'context_window', 'truncation'],
+    'Prompting': ['system_prompt', 'user_prompt_template', 'majority_vote', 'votes'],
+    'Local': ['repo', 'answer_prefix', 'both_orientations'],
+}
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def ranking_fingerprint(config: ConfigParser) -> str:
+    """Hash of the settings in RANKING_SETTINGS. Changes of the preprocessing change the prompt texts and thereby
+    the content hashes of the notebooks, so they do not need to be part of it."""
+    settings = {section: {option: config.get(section, option, fallback=None) for option in options}
+                for section, options in RANKING_SETTINGS.items()}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class IncrementalRanking:
+    """
+    Persisted ranking of the notebooks of one exercise, updated with few comparisons instead of sorting again.
+
+    The JSON file holds the ascending order (best notebook last) and the hash of the prompt text of every notebook.
+    On update(), notebooks that are gone are dropped, notebooks whose prompt text changed are taken out and new ones
+    are inserted by binary search, with about log_2(n) comparisons each. The order of all other notebooks is reused.
+
+    :param path: File of the ranking.
+    :param fingerprint: Identifies the settings of the comparisons, see ranking_fingerprint().
+    """
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.order: list[str] = []
+        self.hashes: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored.get("fingerprint") == fingerprint:
+                self.order, self.hashes = stored["order"], stored["hashes"]
+                logging.info(f"Loaded ranking of {len(self.order)} notebooks from {path}.")
+            else:
+                logging.warning(f"Ranking {path} was made with different settings, ranking all notebooks again.")
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "IncrementalRanking":
+        """Ranking of the configured exercise. Every combination of comparison settings has its own file, so
+        experiments with different models keep their rankings."""
+        exercise = config['Data']['exercises'].strip('/').replace('/', '_')
+        fingerprint = ranking_fingerprint(config)
+        directory = config.get('Sorting', 'ranking_path', fallback='./experiments/rankings/')
+        return cls(os.path.join(directory, f"{exercise}_{fingerprint[:12]}.json"), fingerprint)
+
+    def changes(self, texts: dict[str, str]) -> tuple[list, list, list]:
+        """Notebooks that are new, whose prompt text changed and that were removed since the ranking was saved."""
+        new = [x for x in texts if x not in self.hashes]
+        changed = [x for x in texts if x in self.hashes and self.hashes[x] != content_hash(texts[x])]
+        removed = [x for x in self.order if x not in texts]
+        return new, changed, removed
+
+    def update(self, texts: dict[str, str], cmp, order: list | None = None) -> list:
+        """New ascending order of the notebooks in texts. New and changed notebooks are inserted in the given
+        order (e.g. the shuffled initial order), all others keep their relative order."""
+        new, changed, removed = self.changes(texts)
+        logging.info(f"Updating ranking of {len(self.order)} notebooks: {len(new)} new {new}, "
+                     f"{len(changed)} changed {changed}, {len(removed)} removed {removed}.")
+        ranked = [x for x in self.order if x in texts and x not in changed]
+        position = {x: i for i, x in enumerate(order or texts)}
+        for x in sorted(new + changed, key=lambda x: position.get(x, len(position))):
+            binary_insert(ranked, x, cmp)
+        return ranked
+
+    def save(self, order: list, texts: dict[str, str]):
+        """Stores the order with the hashes of the current prompt texts."""
+        with self._lock:
+            self.order = list(order)
+            self.hashes = {x: content_hash(texts[x]) for x in order}
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # write to a temporary file first, so that a run that dies never leaves a partial ranking
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"fingerprint": self.fingerprint, "order": self.order, "hashes": self.hashes}, f, indent=1)
+            os.replace(tmp_path, self.path)
+        logging.info(f"Saved ranking of {len(order)} notebooks to {self.path}.")
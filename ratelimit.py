@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from configparser import ConfigParser
+from email.utils import parsedate_to_datetime
+
+from logs import current_experiment, global_logger as logging
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parses a Retry-After header given either in seconds or as HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Adaptive token bucket for the requests to one provider.
+
+    The refill rate grows additively with every successful request up to max_rate and is halved on every
+    rate limit response (AIMD). A Retry-After pauses the bucket for all threads using it.
+    """
+    def __init__(self, rate: float, burst: int, min_rate: float, max_rate: float, increase: float):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = float(burst)
+        self.paused_until = 0.0
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self) -> float:
+        """Blocks until a request may be sent. Returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limit(self, retry_after: float | None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+class RetryScheduler:
+    """Central rate limiting and retry scheduling shared by all providers.
+
+    Every provider gets its own TokenBucket, so a rate limit on one endpoint does not stall the others.
+    Retries wait with exponential backoff and full jitter. The total time an experiment spends waiting for retries
+    is capped by retry_budget seconds; once exhausted, wait() returns False and callers give up instead of sleeping.
+    The buckets are shared by all experiments using the scheduler, the retries and the retry budget are counted per
+    experiment (see logs.current_experiment), so one experiment cannot use up the budget of the others.
+    """
+    def __init__(self, requests_per_second: float = 10.0, burst: int = 10, min_rate: float = 0.1,
+                 max_rate: float = 50.0, rate_increase: float = 0.1, base_delay: float = 1.0,
+                 max_delay: float = 60.0, retry_budget: float = 3600.0):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        # per experiment
+        self.retry_seconds: Counter = Counter()
+        self.retries: Counter = Counter()
+        self.rate_limits: dict[str | None, Counter] = defaultdict(Counter)
+        self._buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        # own generator, so that jitter does not consume the experiment's seeded global random state
+        self._random = random.Random()
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "RetryScheduler":
+        return cls(
+            requests_per_second=config.getfloat('RateLimit', 'requests_per_second', fallback=10.0),
+            burst=config.getint('RateLimit', 'burst', fallback=10),
+            min_rate=config.getfloat('RateLimit', 'min_requests_per_second', fallback=0.1),
+            max_rate=config.getfloat('RateLimit', 'max_requests_per_second', fallback=50.0),
+            rate_increase=config.getfloat('RateLimit', 'rate_increase', fallback=0.1),
+            base_delay=config.getfloat('RateLimit', 'base_delay', fallback=1.0),
+            max_delay=config.getfloat('RateLimit', 'max_delay', fallback=60.0),
+            retry_budget=config.getfloat('RateLimit', 'retry_budget', fallback=3600.0),
+        )
+
+    def bucket(self, provider: str) -> TokenBucket:
+        with self._lock:
+            if provider not in self._buckets:
+                self._buckets[provider] = TokenBucket(self.requests_per_second, self.burst, self.min_rate,
+                                                      self.max_rate, self.rate_increase)
+            return self._buckets[provider]
+
+    def acquire(self, provider: str) -> float:
+        return self.bucket(provider).acquire()
+
+    def on_success(self, provider: str):
+        self.bucket(provider).on_success()
+
+    def on_rate_limit(self, provider: str, retry_after: str | float | None = None) -> float | None:
+        """Slows down the provider's bucket. Returns the parsed Retry-After in seconds, if any."""
+        if isinstance(retry_after, str) or retry_after is None:
+            retry_after = parse_retry_after(retry_after)
+        bucket = self.bucket(provider)
+        bucket.on_rate_limit(retry_after)
+        with self._lock:
+            self.rate_limits[current_experiment.get()][provider] += 1
+        logging.warning(f"Rate limit hit for {provider}. Reduced rate to {bucket.rate:.2f} requests/s"
+                        + (f", pausing for {retry_after:.1f} seconds." if retry_after is not None else "."))
+        return retry_after
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def wait(self, attempt: int, max_attempts: int, delay: float | None = None) -> bool:
+        """Sleeps before the next attempt. Returns False if the retry budget of the experiment is exhausted."""
+        if delay is None:
+            delay = self.backoff(attempt)
+        experiment = current_experiment.get()
+        with self._lock:
+            if self.retry_seconds[experiment] + delay > self.retry_budget:
+                logging.critical(f"Retry budget of {self.retry_budget} seconds exhausted after "
+                                 f"{self.retries[experiment]} retries. Giving up.")
+                return False
+            self.retry_seconds[experiment] += delay
+            self.retries[experiment] += 1
+        logging.info(f"Retrying in {delay:.1f} seconds... (Attempt {attempt}/{max_attempts})")
+        time.sleep(delay)
+        return True
+
+    def stats(self) -> str:
+        """Retries and rate limits of the current experiment and the current rates of the shared buckets."""
+        experiment = current_experiment.get()
+        with self._lock:
+            buckets = ", ".join(f"{provider}: {bucket.rate:.2f} requests/s, {self.rate_limits[experiment][provider]} rate limits"
+                                for provider, bucket in self._buckets.items())
+            return (f"Retry scheduler: {self.retries[experiment]} retries, {self.retry_seconds[experiment]:.1f}s waited. "
+                    f"{buckets}")
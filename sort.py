@@ -1,5 +1,8 @@
+import contextvars
 import math
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 def heapsort(arr, cmp=lambda x, y: x < y):
     """
@@ -140,6 +143,488 @@ def bubble_sort(arr, cmp=lambda x, y: x < y):
     return a
 
 
+def heap_top_k(arr, cmp=lambda x, y: x < y, k=1):
+    """
+    Heapsort, der nach k Entnahmen abbricht.
+    Liefert die k größten Elemente in aufsteigender Reihenfolge mit etwa
+    2n + k*log_2(n) statt n*log_2(n) Vergleichen.
+
+    Parameter:
+      arr -- Liste, aus der ausgewählt wird
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+      k   -- Anzahl der gesuchten größten Elemente.
+    """
+    a = arr.copy()
+    n = len(a)
+    k = min(k, n)
+    for start in range(n // 2 - 1, -1, -1):
+        _sift_down_optimized(a, start, n, cmp)
+    for end in range(n - 1, n - 1 - k, -1):
+        a[0], a[end] = a[end], a[0]
+        if end > 0:
+            _sift_down_optimized(a, 0, end, cmp)
+    return a[n - k:] if k else []
+
+
+def quickselect_top_k(arr, cmp=lambda x, y: x < y, k=1):
+    """
+    Quickselect mit anschließendem partiellem Quicksort.
+    Partitioniert wie quicksort, steigt aber nur in Bereiche ab, die Teil der
+    k größten Elemente sind. Im Mittel O(n + k*log(k)) Vergleiche.
+
+    Parameter:
+      arr -- Liste, aus der ausgewählt wird
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+      k   -- Anzahl der gesuchten größten Elemente.
+    """
+    a = arr.copy()
+    n = len(a)
+    k = min(k, n)
+    boundary = n - k  # a[boundary:] soll am Ende die k größten Elemente sortiert enthalten
+
+    def partition(low, high):
+        # Wähle das letzte Element als Pivot
+        pivot = a[high]
+        i = low - 1
+        for j in range(low, high):
+            if cmp(a[j], pivot):
+                i += 1
+                a[i], a[j] = a[j], a[i]
+        a[i + 1], a[high] = a[high], a[i + 1]
+        return i + 1
+
+    def _select(low, high):
+        if low < high and high >= boundary:
+            pivot_index = partition(low, high)
+            # Der linke Bereich wird nur benötigt, soweit er in den oberen k Positionen liegt.
+            if pivot_index > boundary:
+                _select(low, pivot_index - 1)
+            _select(pivot_index + 1, high)
+
+    if k:
+        _select(0, n - 1)
+    return a[boundary:] if k else []
+
+
+def tournament_top_k(arr, cmp=lambda x, y: x < y, k=1):
+    """
+    K.-o.-Turnier mit Turnierbaum.
+    Der Sieger steht nach n-1 Vergleichen fest. Für jeden weiteren Platz wird
+    nur der Pfad des entfernten Siegers neu ausgespielt (etwa log_2(n)
+    Vergleiche), also insgesamt n - 1 + (k-1)*log_2(n) Vergleiche.
+
+    Parameter:
+      arr -- Liste, aus der ausgewählt wird
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+      k   -- Anzahl der gesuchten größten Elemente.
+    """
+    n = len(arr)
+    k = min(k, n)
+    if not k:
+        return []
+    size = 1
+    while size < n:
+        size *= 2
+    # tree[size + i] ist Blatt i, innere Knoten enthalten den Index des Siegers; None = leer
+    tree = [None] * size + list(range(n)) + [None] * (size - n)
+
+    def play(node):
+        left, right = tree[2 * node], tree[2 * node + 1]
+        if left is None or right is None:
+            tree[node] = right if left is None else left
+        else:
+            tree[node] = left if cmp(arr[right], arr[left]) else right
+
+    for node in range(size - 1, 0, -1):
+        play(node)
+
+    winners = []
+    for _ in range(k):
+        winner = tree[1]
+        winners.append(arr[winner])
+        node = size + winner
+        tree[node] = None
+        node //= 2
+        while node:
+            play(node)
+            node //= 2
+    return winners[::-1]
+
+
+def select_bottom_k(algorithm, arr, cmp=lambda x, y: x < y, k=1):
+    """
+    Liefert die k kleinsten Elemente in aufsteigender Reihenfolge, indem ein
+    Top-k-Algorithmus mit umgekehrter Vergleichsfunktion ausgeführt wird.
+    """
+    return algorithm(arr, lambda x, y: cmp(y, x), k=k)[::-1]
+
+
+def binary_insertion_sort(arr, cmp=lambda x, y: x < y):
+    """
+    Insertion Sort mit binärer Suche der Einfügeposition.
+    Benötigt höchstens sum(ceil(log_2(i+1))) für i < n, also etwa n*log_2(n) - n Vergleiche.
+
+    Parameter:
+      arr -- zu sortierende Liste
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+    """
+    a = []
+    for x in arr:
+        binary_insert(a, x, cmp)
+    return a
+
+
+def binary_insert(a, x, cmp=lambda x, y: x < y):
+    """
+    Fügt x an der per binärer Suche bestimmten Position in die bereits
+    sortierte Liste a ein. Benötigt höchstens ceil(log_2(len(a)+1)) Vergleiche.
+
+    Parameter:
+      a   -- sortierte Liste, wird verändert
+      x   -- einzufügendes Element
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+    """
+    a.insert(_binary_search(a, x, 0, len(a), cmp), x)
+    return a
+
+
+def _binary_search(a, x, low, high, cmp):
+    """Einfügeposition von x im sortierten Bereich a[low:high] (hinter gleichen Elementen)."""
+    while low < high:
+        mid = (low + high) // 2
+        if cmp(x, a[mid]):
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+
+def merge_insertion_sort(arr, cmp=lambda x, y: x < y):
+    """
+    Merge-Insertion-Sort nach Ford und Johnson.
+    Kommt mit nahezu der informationstheoretisch minimalen Anzahl von
+    ceil(log_2(n!)) Vergleichen aus und eignet sich daher, wenn jeder
+    Vergleich teuer ist.
+
+    Parameter:
+      arr -- zu sortierende Liste
+      cmp -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+             Standard: lambda x, y: x < y.
+    """
+    return _ford_johnson(list(arr), cmp)
+
+
+def _ford_johnson(items, cmp):
+    n = len(items)
+    if n <= 1:
+        return items
+    # Paare bilden als (größeres, kleineres) Element
+    pairs = []
+    for i in range(0, n - 1, 2):
+        x, y = items[i], items[i + 1]
+        pairs.append((y, x) if cmp(x, y) else (x, y))
+    # Paare rekursiv nach ihrem größeren Element sortieren
+    pairs = _ford_johnson(pairs, lambda p, q: cmp(p[0], q[0]))
+
+    # Hauptkette als (Index des Paares, Element); das kleinste Element ist ohne Vergleich bekannt.
+    chain = [(None, pairs[0][1])] + [(i, p[0]) for i, p in enumerate(pairs)]
+    pending = [p[1] for p in pairs] + ([items[-1]] if n % 2 else [])
+
+    # Einfügen in Gruppen gemäß der Jacobsthal-Zahlen 1, 3, 5, 11, 21, ..., innerhalb einer Gruppe absteigend,
+    # sodass jede binäre Suche höchstens 2^k - 1 Elemente umfasst.
+    last, k = 1, 2
+    while last < len(pending):
+        group_end = min((2 ** (k + 1) + (-1) ** k) // 3, len(pending))
+        for j in range(group_end, last, -1):
+            x = pending[j - 1]
+            if j <= len(pairs):
+                # obere Schranke ist der Partner aus dem Paar
+                bound = next(idx for idx, (tag, _) in enumerate(chain) if tag == j - 1)
+            else:
+                bound = len(chain)
+            low, high = 0, bound
+            while low < high:
+                mid = (low + high) // 2
+                if cmp(x, chain[mid][1]):
+                    high = mid
+                else:
+                    low = mid + 1
+            chain.insert(low, (None, x))
+        last, k = group_end, k + 1
+
+    return [x for _, x in chain]
+
+
+def active_ranking(arr, cmp=lambda x, y: x < y, budget=None, seed=None):
+    """
+    Aktives Ranking mit Bradley-Terry-Modell für verrauschte Vergleiche.
+    Nach einem ersten Durchlauf über benachbarte Elemente wird immer das
+    Paar benachbarter Elemente der aktuellen Rangfolge verglichen, dessen
+    Ausgang laut Modell am unsichersten ist. Widersprüchliche Antworten
+    werden durch wiederholte Vergleiche gemittelt statt übernommen. Dafür
+    muss cmp bei Wiederholungen neu antworten und darf kein gecachtes
+    Ergebnis liefern (siehe PRPmodel.repeat_index).
+
+    Parameter:
+      arr    -- zu sortierende Liste
+      cmp    -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+                Standard: lambda x, y: x < y.
+      budget -- Anzahl der Vergleiche. Standard: ceil(n*log_2(n)).
+      seed   -- Seed für die zufällige Reihenfolge der Elemente im Vergleich.
+    """
+    n = len(arr)
+    if n <= 1:
+        return list(arr)
+    if budget is None:
+        budget = math.ceil(n * math.log2(n))
+    rng = random.Random(seed)
+    wins = [[0] * n for _ in range(n)]  # wins[i][j]: Anzahl, wie oft arr[i] besser als arr[j] war
+    counts = [[0] * n for _ in range(n)]
+
+    def compare(i, j):
+        # zufällige Position im Prompt, um Positions-Bias nicht systematisch zu verstärken
+        if rng.random() < 0.5:
+            i_better = cmp(arr[j], arr[i])
+        else:
+            i_better = not cmp(arr[i], arr[j])
+        winner, loser = (i, j) if i_better else (j, i)
+        wins[winner][loser] += 1
+        counts[i][j] += 1
+        counts[j][i] += 1
+
+    for i in range(min(n - 1, budget)):
+        compare(i, i + 1)
+
+    scores = _bradley_terry(wins)
+    for _ in range(budget - (n - 1)):
+        order = sorted(range(n), key=lambda i: scores[i])
+
+        def information(pair):
+            i, j = pair
+            p = scores[i] / (scores[i] + scores[j])
+            return p * (1 - p) / (1 + counts[i][j])
+
+        compare(*max(zip(order, order[1:]), key=information))
+        scores = _bradley_terry(wins)
+
+    return [arr[i] for i in sorted(range(n), key=lambda i: scores[i])]
+
+
+def _bradley_terry(wins, iterations=50, prior=0.5):
+    """
+    Schätzt die Stärken des Bradley-Terry-Modells mit dem MM-Algorithmus.
+    Jedes Element erhält prior Siege und Niederlagen gegen einen virtuellen
+    Gegner der Stärke 1, damit die Schätzung auch ohne Niederlagen existiert.
+    """
+    n = len(wins)
+    scores = [1.0] * n
+    for _ in range(iterations):
+        new_scores = []
+        for i in range(n):
+            won = sum(wins[i]) + prior
+            denominator = 2 * prior / (scores[i] + 1)
+            for j in range(n):
+                games = wins[i][j] + wins[j][i]
+                if games:
+                    denominator += games / (scores[i] + scores[j])
+            new_scores.append(won / denominator)
+        scores = new_scores
+    return scores
+
+
+class CountingComparator:
+    """
+    Zählt die Aufrufe einer Vergleichsfunktion, z. B. um API-Kosten
+    verschiedener Algorithmen gegenüberzustellen.
+    """
+    def __init__(self, cmp=lambda x, y: x < y):
+        self.cmp = cmp
+        self.count = 0
+        self.__name__ = getattr(cmp, '__name__', type(cmp).__name__)
+        self._lock = threading.Lock()
+
+    def __call__(self, x, y):
+        with self._lock:
+            self.count += 1
+        return self.cmp(x, y)
+
+
+class BatchComparator:
+    """
+    Führt voneinander unabhängige Vergleiche gebündelt und parallel aus.
+
+    Parameter:
+      cmp             -- Vergleichsfunktion (Lambda), die zwei Elemente vergleicht.
+      max_concurrency -- maximale Anzahl gleichzeitig laufender Vergleiche.
+
+    Das Attribut rounds zählt die Anzahl der Runden, also der nacheinander
+    ausgeführten Bündel von Vergleichen.
+    """
+    def __init__(self, cmp=lambda x, y: x < y, max_concurrency=8):
+        self.cmp = cmp
+        self.max_concurrency = max_concurrency
+        self.rounds = 0
+
+    def __call__(self, pairs):
+        if not pairs:
+            return []
+        self.rounds += 1
+        if self.max_concurrency <= 1 or len(pairs) == 1:
+            return [self.cmp(x, y) for x, y in pairs]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pairs))) as executor:
+            # Kontext (z. B. das laufende Experiment für das Logging) an die Threads weitergeben
+            futures = [executor.submit(contextvars.copy_context().run, self.cmp, *pair) for pair in pairs]
+            return [future.result() for future in futures]
+
+
+def _batch_comparator(cmp, max_concurrency):
+    return cmp if isinstance(cmp, BatchComparator) else BatchComparator(cmp, max_concurrency)
+
+
+def _run_lockstep(batch, steps):
+    """
+    Treibt mehrere Generatoren im Gleichschritt an. Jeder Generator liefert
+    (yield) das nächste zu vergleichende Paar und erhält das Ergebnis zurück.
+    Die Paare aller noch aktiven Generatoren werden als eine Runde verglichen.
+    """
+    pending = {}
+    for step in steps:
+        try:
+            pending[step] = next(step)
+        except StopIteration:
+            pass
+    while pending:
+        active = list(pending)
+        results = batch([pending[step] for step in active])
+        pending = {}
+        for step, result in zip(active, results):
+            try:
+                pending[step] = step.send(result)
+            except StopIteration:
+                pass
+
+
+def _sift_down_optimized_steps(a, start, end):
+    """
+    Wie _sift_down_optimized, aber als Generator, der jeden Vergleich als Paar
+    ausgibt, statt cmp selbst aufzurufen.
+    """
+    root = start
+    tmp = a[root]
+
+    child = 2 * root + 1
+    while child < end:
+        if child + 1 < end and (yield a[child], a[child + 1]):
+            child += 1
+        a[root] = a[child]
+        root = child
+        child = 2 * root + 1
+
+    insertion_point = root
+    parent = (insertion_point - 1) // 2
+    while insertion_point > start and (yield a[parent], tmp):
+        a[insertion_point] = a[parent]
+        insertion_point = parent
+        parent = (insertion_point - 1) // 2
+    a[insertion_point] = tmp
+
+
+def parallel_heapsort(arr, cmp=lambda x, y: x < y, max_concurrency=8):
+    """
+    Heapsort mit parallelem Heap-Aufbau.
+    Die Sift-downs aller Knoten einer Ebene betreffen disjunkte Teilbäume und
+    werden im Gleichschritt ausgeführt, sodass ihre Vergleiche gebündelt
+    werden. Die Entnahmephase bleibt sequentiell.
+
+    Parameter:
+      arr             -- zu sortierende Liste
+      cmp             -- Vergleichsfunktion (Lambda) oder BatchComparator.
+      max_concurrency -- maximale Anzahl gleichzeitig laufender Vergleiche.
+    """
+    batch = _batch_comparator(cmp, max_concurrency)
+    a = arr.copy()
+    n = len(a)
+    last_parent = n // 2 - 1
+    if last_parent >= 0:
+        # Ebenen von unten nach oben: Ebene d enthält die Knoten 2^d - 1 bis 2^(d+1) - 2
+        for depth in range(int(math.log2(last_parent + 1)), -1, -1):
+            level = range(2 ** depth - 1, min(2 ** (depth + 1) - 1, last_parent + 1))
+            _run_lockstep(batch, [_sift_down_optimized_steps(a, start, n) for start in level])
+    for end in range(n - 1, 0, -1):
+        a[0], a[end] = a[end], a[0]
+        _run_lockstep(batch, [_sift_down_optimized_steps(a, 0, end)])
+    return a
+
+
+def parallel_quicksort(arr, cmp=lambda x, y: x < y, max_concurrency=8):
+    """
+    Quicksort, bei dem alle Partitionen einer Rekursionsebene gleichzeitig
+    bearbeitet werden. Wie bei quicksort ist das letzte Element Pivot. Alle
+    Vergleiche mit den Pivots einer Ebene bilden eine Runde, sodass im Mittel
+    nur O(log n) Runden benötigt werden.
+
+    Parameter:
+      arr             -- zu sortierende Liste
+      cmp             -- Vergleichsfunktion (Lambda) oder BatchComparator.
+      max_concurrency -- maximale Anzahl gleichzeitig laufender Vergleiche.
+    """
+    batch = _batch_comparator(cmp, max_concurrency)
+    a = arr.copy()
+    segments = [(0, len(a) - 1)]
+    while segments:
+        segments = [(low, high) for low, high in segments if low < high]
+        results = iter(batch([(a[j], a[high]) for low, high in segments for j in range(low, high)]))
+        next_segments = []
+        for low, high in segments:
+            pivot = a[high]
+            smaller, larger = [], []
+            for j in range(low, high):
+                (smaller if next(results) else larger).append(a[j])
+            a[low:high + 1] = smaller + [pivot] + larger
+            pivot_index = low + len(smaller)
+            next_segments += [(low, pivot_index - 1), (pivot_index + 1, high)]
+        segments = next_segments
+    return a
+
+
+def odd_even_sort(arr, cmp=lambda x, y: x < y, max_concurrency=8):
+    """
+    Odd-Even-Transposition-Sort, die parallele Variante von Bubble Sort.
+    Abwechselnd werden alle Paare an geraden bzw. ungeraden Positionen
+    gleichzeitig verglichen. Nach spätestens n Runden ist die Liste sortiert.
+
+    Parameter:
+      arr             -- zu sortierende Liste
+      cmp             -- Vergleichsfunktion (Lambda) oder BatchComparator.
+      max_concurrency -- maximale Anzahl gleichzeitig laufender Vergleiche.
+
+    Optimierung:
+      - Abbruch, sobald zwei aufeinanderfolgende Runden keine Vertauschung enthalten.
+    """
+    batch = _batch_comparator(cmp, max_concurrency)
+    a = arr.copy()
+    n = len(a)
+    rounds_without_swap = 0
+    for phase in range(n):
+        indices = range(1 + phase % 2, n, 2)
+        # Vergleiche benachbarte Elemente; tausche, falls a[j] vor a[j-1] kommen soll.
+        results = batch([(a[j], a[j - 1]) for j in indices])
+        swapped = False
+        for j, result in zip(indices, results):
+            if result:
+                a[j], a[j - 1] = a[j - 1], a[j]
+                swapped = True
+        rounds_without_swap = 0 if swapped else rounds_without_swap + 1
+        if rounds_without_swap >= 2:
+            break
+    return a
+
+
 if __name__ == "__main__":
     global com_count
     com_count = 0
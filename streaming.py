@@ -0,0 +1,118 @@
+"""Incremental parsing of streamed chat completions (server-sent events) with early detection of the verdict.
+
+Reasoning models like DeepSeek-R1 write a long <think> trace before their answer. The answer itself only needs
+to be 'Notebook A' or 'Notebook B', so the stream is stopped as soon as the text after the closing </think> is
+such a verdict on a complete line, instead of waiting for the end of the message (or for the output token limit).
+Answers without reasoning are short anyway; they are read to the end and checked by parse_response as usual.
+"""
+import json
+import re
+import time
+
+THINK_START, THINK_END = "<think>", "</think>"
+# the whole answer after the reasoning is one line with the verdict, in the forms parse_response accepts
+VERDICT_PATTERN = re.compile(r'\s*(?:\\boxed\{|["\'*]+)?\s*Notebook (A|B)[}"\'*]?[.*]*[ \t]*\n\s*', re.IGNORECASE)
+
+
+class VerdictDetector:
+    """Accumulates the content of one choice and tells when its verdict is known, i.e. when the reasoning is closed
+    and the answer after it is a complete line with the verdict."""
+    def __init__(self):
+        self.text = ""
+        self.verdict: str | None = None
+
+    def answer(self) -> str | None:
+        """Text after the reasoning, or None while the reasoning is not finished or there is none."""
+        stripped = self.text.lstrip()
+        if not stripped.startswith(THINK_START):
+            return None
+        end = stripped.find(THINK_END)
+        return None if end == -1 else stripped[end + len(THINK_END):]
+
+    def feed(self, delta: str) -> str | None:
+        """Adds the delta and returns the verdict ('A' or 'B') once it is known. Once the verdict is known, further
+        deltas are ignored, so that the text still ends with it."""
+        if self.verdict is not None:
+            return self.verdict
+        self.text += delta
+        answer = self.answer()
+        match = VERDICT_PATTERN.fullmatch(answer) if answer is not None else None
+        if match:
+            self.verdict = match.group(1).upper()
+        return self.verdict
+
+
+class StreamedCompletion:
+    """
+    Collects the chunks of a streamed chat completion into the response of a non-streamed one.
+
+    feed_line() takes the lines of the server-sent events of OpenAI-compatible endpoints, feed_chunk() the decoded
+    chunks (also of the Azure SDK). Both return True once the stream can be stopped, i.e. when it is finished or
+    the verdicts of all n choices are known before the stream ends. Choices stopped at their verdict are reported with finish_reason
+    'stop', as their answer is complete.
+
+    :param n: Number of choices requested.
+    :param start: Start of the request (time.perf_counter()), to measure the time to the verdict.
+    """
+    def __init__(self, n: int = 1, start: float | None = None):
+        self.n = n
+        self.start = time.perf_counter() if start is None else start
+        self.detectors: dict[int, VerdictDetector] = {}
+        self.finish_reasons: dict[int, str] = {}
+        self.chunk: dict = {}
+        self.usage: dict | None = None
+        self.done = False
+        self.time_to_verdict: float | None = None
+
+    def feed_line(self, line: str) -> bool:
+        line = line.strip()
+        if not line.startswith("data:"):
+            return self.done  # empty lines between events, comments and other fields
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            self.done = True
+            return True
+        return self.feed_chunk(json.loads(payload))
+
+    def feed_chunk(self, chunk: dict) -> bool:
+        self.chunk = chunk
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            detector = self.detectors.setdefault(choice.get("index", 0), VerdictDetector())
+            stopped = detector.verdict is not None  # not reading this choice anymore
+            detector.feed((choice.get("delta") or {}).get("content") or "")
+            if choice.get("finish_reason") and not stopped:
+                self.finish_reasons[choice.get("index", 0)] = choice["finish_reason"]
+        if self.time_to_verdict is None and self.verdicts_known():
+            self.time_to_verdict = time.perf_counter() - self.start
+        # if all choices finished by themselves, the rest (usage and [DONE]) is read as well
+        return self.done or (self.verdicts_known() and self.stopped_early)
+
+    def verdicts_known(self) -> bool:
+        return len(self.detectors) >= self.n and all(d.verdict for d in self.detectors.values())
+
+    @property
+    def stopped_early(self) -> bool:
+        return any(i not in self.finish_reasons for i in self.detectors)
+
+    def response(self) -> dict:
+        """The response in the format of a non-streamed chat completion."""
+        response = {
+            "id": self.chunk.get("id"),
+            "object": "chat.completion",
+            "model": self.chunk.get("model"),
+            "choices": [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": detector.text},
+                    "finish_reason": self.finish_reasons.get(i, "stop" if detector.verdict else None),
+                }
+                for i, detector in sorted(self.detectors.items())
+            ],
+            "stopped_early": self.stopped_early,
+            "time_to_verdict": self.time_to_verdict,
+        }
+        if self.usage:
+            response["usage"] = self.usage
+        return response
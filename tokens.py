@@ -0,0 +1,78 @@
+import functools
+import os
+
+from logs import global_logger as logging
+
+# Hugging Face repositories whose tokenizers match the models of the providers in PRPmodel
+MODEL_TOKENIZERS: dict[str, str] = {
+    # Azure
+    "DeepSeek-R1": "deepseek-ai/DeepSeek-R1",
+    "Llama-3.3-70B-Instruct": "meta-llama/Llama-3.3-70B-Instruct",
+    # KISSKI
+    "deepseek-r1-distill-llama-70b": "deepseek-ai/DeepSeek-R1-Distill-Llama-70B",
+    "llama-3.3-70b-instruct": "meta-llama/Llama-3.3-70B-Instruct",
+    "qwen2.5-coder-32b-instruct": "Qwen/Qwen2.5-Coder-32B-Instruct",
+    "mistral-large-instruct": "mistralai/Mistral-Large-Instruct-2411",
+    # LFI
+    "deepseek-r1:8b": "deepseek-ai/DeepSeek-R1-Distill-Llama-8B",
+    "llama3.1:8b": "meta-llama/Llama-3.1-8B-Instruct",
+    "gemma2:latest": "google/gemma-2-9b-it",
+    "phi3:latest": "microsoft/Phi-3-mini-4k-instruct",
+}
+
+# context windows in tokens as served by the providers, can be overridden with [Model] context_window
+MODEL_CONTEXT_WINDOWS: dict[str, int] = {
+    "DeepSeek-R1": 128_000,
+    "Llama-3.3-70B-Instruct": 128_000,
+    "deepseek-r1-distill-llama-70b": 32_000,
+    "llama-3.3-70b-instruct": 128_000,
+    "qwen2.5-coder-32b-instruct": 32_000,
+    "mistral-large-instruct": 32_000,
+    "deepseek-r1:8b": 8_192,
+    "llama3.1:8b": 8_192,
+    "gemma2:latest": 8_192,
+    "phi3:latest": 4_096,
+}
+
+TRUNCATION_MARKER = "\n[... {n} characters truncated ...]\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model: str):
+    """Loads the tokenizer of the model on first use. Returns None if it is not available, e.g. offline."""
+    repo = MODEL_TOKENIZERS.get(model)
+    if repo is None:
+        logging.warning(f"No tokenizer known for model '{model}', estimating token counts.")
+        return None
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(repo, token=os.getenv("HUGGINGFACE"))
+        logging.info(f"Loaded tokenizer '{repo}' for model '{model}'.")
+        return tokenizer
+    except Exception as e:
+        logging.warning(f"Could not load tokenizer '{repo}' for model '{model}', estimating token counts: {e}")
+        return None
+
+
+def count_tokens(model: str | None, text: str) -> int:
+    """Counts the tokens of text with the model's tokenizer, or estimates them with four characters per token."""
+    tokenizer = get_tokenizer(model) if model else None
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_middle(text: str, max_tokens: int, count) -> str:
+    """Cuts characters from the middle of text until count(text) <= max_tokens.
+    Beginning (task) and end (last solutions) of a notebook are kept."""
+    if count(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)  # number of characters to keep
+    while low < high:
+        keep = (low + high + 1) // 2
+        candidate = text[:keep // 2] + TRUNCATION_MARKER.format(n=len(text) - keep) + text[len(text) - (keep - keep // 2):]
+        if count(candidate) <= max_tokens:
+            low = keep
+        else:
+            high = keep - 1
+    return text[:low // 2] + TRUNCATION_MARKER.format(n=len(text) - low) + text[len(text) - (low - low // 2):]